@@ -218,24 +218,25 @@ class defect_list:
 # build kdtree and check if it's near anything to recombine (one function)
 #  
 
-defects = defect_list([defect('V', gen_pos(gauss))])
-for _ in range(200):
-    defects.append(defect('V', gen_pos(gauss)))
-arr = [] 
-
-#while len(defects) > 5:
-i = 0
-p = 10
-while i < 400000:
-    if i % 100 == 0:
-        #print(i)
-        arr.append(defects.atoms())
-    if i % 1000 == 0:
-        print(i)
-    j = np.random.choice(range(len(defects)), p=defects.get_migrations()/sum(defects.get_migrations()))
-    defects[j].random_walk()
-    defects.check_neighbours(j)
-    i += 1
+if __name__ == "__main__":
+    defects = defect_list([defect('V', gen_pos(gauss))])
+    for _ in range(200):
+        defects.append(defect('V', gen_pos(gauss)))
+    arr = [] 
+
+    #while len(defects) > 5:
+    i = 0
+    p = 10
+    while i < 400000:
+        if i % 100 == 0:
+            #print(i)
+            arr.append(defects.atoms())
+        if i % 1000 == 0:
+            print(i)
+        j = np.random.choice(range(len(defects)), p=defects.get_migrations()/sum(defects.get_migrations()))
+        defects[j].random_walk()
+        defects.check_neighbours(j)
+        i += 1
     
-arr.append(defects.atoms())
-write('test.extxyz', arr)
+    arr.append(defects.atoms())
+    write('test.extxyz', arr)
@@ -0,0 +1,54 @@
+"""
+Bytes per defect for the old layout (one python object with a __dict__ per defect, stored in
+a dict keyed by tuples) against the DefectStore backed Lattice in new3.py.
+Usage: python bench_memory.py [num_defects]
+"""
+import sys
+import tracemalloc
+import numpy as np
+from new3 import Lattice, Nitrogen
+
+class OldDefect:
+    # what every defect in new3.py used to look like
+    def __init__(self, pos, lattice=None):
+        self.pos = tuple(pos)
+        self.rate = 0
+        self.species = 'N'
+        self.lattice = lattice
+
+def random_sites(n, box):
+    # distinct even sublattice sites, all multiples of 4 like random_uniform_pos
+    sites = np.unique(4 * np.random.randint(0, box // 4, size=(2 * n, 3)), axis=0)
+    np.random.shuffle(sites)
+    return sites[:n]
+
+def measure(build, sites):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(sites) # hold on to it until we've taken the reading
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(sites)
+
+def build_old(sites):
+    defects = {}
+    for site in sites:
+        defect = OldDefect(site.tolist())
+        defects[defect.pos] = defect
+    return defects
+
+def build_store(sites, cell_size=None, capture_zones=False):
+    lattice = Lattice([1024, 1024, 1024], cell_size=cell_size, capture_zones=capture_zones)
+    for site in sites:
+        lattice.add_defect(Nitrogen(site.tolist()))
+    return lattice
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    sites = random_sites(n, 1024)
+    print(f"{len(sites)} defects")
+    print(f"old objects + dict:          {measure(build_old, sites):8.1f} bytes/defect")
+    print(f"store + rates + dict:        {measure(build_store, sites):8.1f} bytes/defect")
+    print(f"  ... plus the cell list:    {measure(lambda s: build_store(s, cell_size=8), sites):8.1f} bytes/defect")
+    # the zone bitmap and crowd grid are a fixed cost for the box, however many defects there are
+    print(f"  ... plus capture zones:    {measure(lambda s: build_store(s, cell_size=8, capture_zones=True), sites):8.1f} bytes/defect (default)")
@@ -0,0 +1,252 @@
+"""
+Steps/s, simulated s per wall s, peak RSS and time to first step of every KMC engine on fixed
+scenarios, each run in its own process. --compare an older --out to see the ratios.
+Usage: python benchmark.py [--engines new3 claude] [--scenarios 256-asgrown] [--seconds 10]
+                           [--out benchmark.json] [--compare old.json]
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time as clock
+import numpy as np
+
+T = 1100
+
+# fixed boxes, concentrations and seeds so runs from different commits line up
+scenarios = {
+    "64-irradiated": {"box": 64, "N_ppm": 1600, "V_ppm": 4000, "seed": 1}, # as grown would be less than one vacancy
+    "64-dense": {"box": 64, "N_ppm": 16000, "V_ppm": 4000, "seed": 2},
+    "256-asgrown": {"box": 256, "N_ppm": 160, "V_ppm": 40, "seed": 3},
+    "256-irradiated": {"box": 256, "N_ppm": 160, "V_ppm": 400, "seed": 4},
+    "1024-asgrown": {"box": 1024, "N_ppm": 160, "V_ppm": 40, "seed": 5},
+    "1024-irradiated": {"box": 1024, "N_ppm": 160, "V_ppm": 400, "seed": 6},
+}
+
+basis = np.array([[0, 0, 0], [0, 2, 2], [2, 0, 2], [2, 2, 0], [1, 1, 1], [1, 3, 3], [3, 1, 3], [3, 3, 1]])
+
+def ppm_to_num(ppm, box):
+    # same as new3.ppm_to_num, 8 atoms per 4x4x4 cube
+    return round(ppm * box ** 3 / 80e6)
+
+def diamond_sites(n, box, rng):
+    """n distinct diamond sites spread uniformly over the box, for the engines that don't place their own"""
+    sites = np.empty((0, 3), dtype=np.int64)
+    while len(sites) < n:
+        new = 4 * rng.integers(0, box // 4, (n, 3)) + basis[rng.integers(0, 8, n)]
+        sites = np.concatenate([sites, new])
+        sites = sites[np.sort(np.unique((sites[:, 0] * box + sites[:, 1]) * box + sites[:, 2], return_index=True)[1])]
+    return sites[:n]
+
+
+class Engine:
+    """
+    What the benchmark needs from an engine: set up a scenario in __init__, step() does one
+    event and returns False once nothing can move, self.time is the simulated time so far.
+    """
+    time = 0.0
+
+
+class New3(Engine):
+    # Lattice from new3.py as it's run in production
+    first_passage = False
+
+    def __init__(self, box, vacancies, nitrogens, seed):
+        from new3 import Lattice, Vacancy, Nitrogen
+        self.lattice = Lattice([box] * 3, seed=seed, temperature=T, first_passage=self.first_passage)
+        self.lattice.populate(Vacancy, vacancies)
+        self.lattice.populate(Nitrogen, nitrogens)
+
+    @property
+    def time(self):
+        return self.lattice.time
+
+    def step(self):
+        return self.lattice.step() is not None
+
+
+class New3FirstPassage(New3):
+    first_passage = True
+
+
+class Claude(Engine):
+    # DefectKMC from claude.py, nitrogen goes in as its immobile-ish "impurity"
+    def __init__(self, box, vacancies, nitrogens, seed):
+        from claude import DefectKMC
+        np.random.seed(seed)
+        sites = diamond_sites(vacancies + nitrogens, box, np.random.default_rng(seed))
+        self.sim = DefectKMC((box, box, box), cutoff_radius=5.0, temperature=T)
+        for i, site in enumerate(sites):
+            self.sim.add_defect(site, "vacancy" if i < vacancies else "impurity")
+
+    def step(self):
+        dt = self.sim.run_kmc_step()
+        if dt is None:
+            return False
+        self.time += dt
+        return True
+
+
+class Backup(Engine):
+    # defect_list from backup.py. It keeps no clock, so time goes on by the usual exponential
+    # waiting time over the sum of its migration rates
+    def __init__(self, box, vacancies, nitrogens, seed):
+        import backup
+        np.random.seed(seed)
+        random.seed(seed)
+        self.rng = np.random.default_rng(seed)
+        # its box is s / 4 * a wide, and wrap() can leave things right on the edge which cKDTree won't take
+        backup.s = (box - 0.5) * 4 / backup.a
+        kBT = backup.kB * T
+        backup.diffusion_dict.update(V=backup.nu * np.exp(-2.3 / kBT), I=backup.nu * np.exp(-1.8 / kBT))
+        sites = diamond_sites(vacancies + nitrogens, box, self.rng)
+        # pairs has to be a new list every time, the default one is shared between them all
+        self.defects = backup.defect_list([backup.defect("V" if i < vacancies else "Ns", site, pairs=[]) for i, site in enumerate(sites)])
+
+    def step(self):
+        rates = np.array(self.defects.get_migrations())
+        total = rates.sum()
+        if total == 0:
+            return False
+        j = np.random.choice(range(len(self.defects)), p=rates / total)
+        self.defects[j].random_walk()
+        self.defects.check_neighbours(j)
+        self.time += self.rng.exponential() / total
+        return True
+
+
+class Main(Engine):
+    # the cKDTree loop from main.py. It only knows vacancies and interstitials so nitrogen stands
+    # in as interstitials to keep the number of defects the same, and like backup.py it has no clock
+    def __init__(self, box, vacancies, nitrogens, seed):
+        import main
+        random.seed(seed)
+        self.rng = np.random.default_rng(seed)
+        self.main = main
+        main.limit = box - 1 # wrap() can leave things on limit, which has to be inside the cKDTree box
+        main.cell = [box] * 3
+        self.defects = []
+        for i, site in enumerate(diamond_sites(vacancies + nitrogens, box, self.rng)):
+            defect = main.defect("vacancy" if i < vacancies else "interstitial")
+            defect.coords = site.copy()
+            self.defects.append(defect)
+        self.coords = [defect.coords for defect in self.defects]
+        kBT = main.kB * T
+        self.rates = {kind: main.nu * math.exp(-barrier / kBT) for kind, barrier in main.rate_dict.items()}
+
+    def step(self):
+        if len(self.defects) < 2:
+            return False
+        index = random.randint(0, len(self.defects) - 1)
+        defect = self.defects[index]
+        defect.hop()
+        neighbour = defect.neighbour_index(self.coords)
+        if neighbour is not None:
+            self.main.combine(self.defects, index, neighbour)
+            self.coords = [defect.coords for defect in self.defects]
+        self.time += self.rng.exponential() / sum(self.rates[defect.type] for defect in self.defects)
+        return True
+
+
+engines = {"new3": New3, "new3-fp": New3FirstPassage, "claude": Claude, "backup": Backup, "main": Main}
+
+
+def peak_rss():
+    # in MB, linux gives kB and macOS bytes
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def measure(engine, name, max_steps, seconds):
+    """Runs one engine on one scenario in this process and returns its numbers"""
+    scenario = scenarios[name]
+    box = scenario["box"]
+    vacancies, nitrogens = ppm_to_num(scenario["V_ppm"], box), ppm_to_num(scenario["N_ppm"], box)
+    result = {"engine": engine, "scenario": name, "vacancies": vacancies, "nitrogens": nitrogens, "rss_before_mb": peak_rss()}
+    start = clock.perf_counter()
+    sim = engines[engine](box, vacancies, nitrogens, scenario["seed"])
+    result["setup_s"] = clock.perf_counter() - start
+    moved = sim.step()
+    result["time_to_first_step_s"] = clock.perf_counter() - start
+    # the rest of the steps are timed on their own so setting up doesn't count against the rate
+    steps, start_time = 0, sim.time
+    start = clock.perf_counter()
+    while moved and steps < max_steps and clock.perf_counter() - start < seconds:
+        moved = sim.step()
+        steps += moved
+    wall = clock.perf_counter() - start
+    result.update({"steps": steps, "wall_s": wall, "sim_time": sim.time - start_time, "stalled": not moved,
+                   "steps_per_s": steps / wall if wall > 0 else 0.0,
+                   "sim_s_per_s": (sim.time - start_time) / wall if wall > 0 else 0.0,
+                   "peak_rss_mb": peak_rss()})
+    return result
+
+def run(engine, name, max_steps, seconds, timeout):
+    """measure() in a fresh python, anything it prints is thrown away"""
+    command = [sys.executable, __file__, "--child", engine, name, "--steps", str(max_steps), "--seconds", str(seconds)]
+    try:
+        done = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {"engine": engine, "scenario": name, "error": f"timed out after {timeout} s"}
+    lines = done.stdout.strip().splitlines()
+    if done.returncode != 0 or not lines:
+        return {"engine": engine, "scenario": name, "error": (done.stderr.strip().splitlines() or [f"exit code {done.returncode}"])[-1]}
+    return json.loads(lines[-1])
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, old):
+    """Prints new/old steps/s for every engine and scenario in both"""
+    before = {(entry["engine"], entry["scenario"]): entry for entry in old["results"] if "error" not in entry}
+    print(f"against {old.get('commit')}:")
+    for entry in results:
+        previous = before.get((entry["engine"], entry["scenario"]))
+        if previous is None or "error" in entry or not previous["steps_per_s"]:
+            continue
+        print(f"{entry['engine']:>8} {entry['scenario']:>16}: {entry['steps_per_s'] / previous['steps_per_s']:6.2f}x steps/s"
+              f" {entry['peak_rss_mb'] / previous['peak_rss_mb']:6.2f}x RSS")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engines", nargs="+", choices=list(engines), default=list(engines))
+    parser.add_argument("--scenarios", nargs="+", choices=list(scenarios), default=list(scenarios))
+    parser.add_argument("--steps", type=int, default=100000, help="most steps to time per run")
+    parser.add_argument("--seconds", type=float, default=10, help="most wall seconds to spend stepping per run")
+    parser.add_argument("--timeout", type=float, default=600, help="give up on a run (setting up included) after this long")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="an earlier --out to compare against")
+    parser.add_argument("--child", nargs=2, metavar=("ENGINE", "SCENARIO"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        result = measure(*args.child, args.steps, args.seconds)
+        print(json.dumps(result))
+        sys.exit()
+
+    results = []
+    for name in args.scenarios:
+        for engine in args.engines:
+            result = run(engine, name, args.steps, args.seconds, args.timeout)
+            results.append(result)
+            if "error" in result:
+                print(f"{engine:>8} {name:>16}: {result['error']}")
+            else:
+                print(f"{engine:>8} {name:>16}: {result['steps_per_s']:10.1f} steps/s {result['sim_s_per_s']:10.3g} sim s/s"
+                      f" {result['peak_rss_mb']:8.1f} MB, first step after {result['time_to_first_step_s']:.2f} s")
+    with open(args.out, "w") as f:
+        json.dump({"commit": commit(), "python": platform.python_version(), "machine": platform.platform(),
+                   "T": T, "scenarios": scenarios, "results": results}, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
@@ -0,0 +1,152 @@
+import numpy as np
+
+# number of each of the 64 diamond sites in an 8x8x8 block, by (x & 7) | (y & 7) << 3 | (z & 7) << 6, -1 if it isn't one
+def diamond(x, y, z):
+    return (x % 2 == y % 2 == z % 2 == 0 and (x + y + z) % 4 == 0) or (x % 2 == y % 2 == z % 2 == 1 and (x + y + z + 1) % 4 == 0)
+
+block_sites = [(x, y, z) for z in range(8) for y in range(8) for x in range(8) if diamond(x, y, z)]
+local_site = [-1] * 512
+for i, (x, y, z) in enumerate(block_sites):
+    local_site[x | y << 3 | z << 6] = i
+block_sites = np.array(block_sites, dtype=np.int64)
+local_sites = np.array(local_site, dtype=np.int64)
+
+
+class BlockedSites:
+    """
+    Stands in for the site key -> slot dict on Lattice when there are too many defects for a dict.
+    Each 8x8x8 block (64 sites) gets a row of slots and a bitmap the first time anything lands in it.
+    Power of two boxes only
+    """
+    def __init__(self, box, capacity=1024):
+        assert all(box[i] >= 8 and box[i] & (box[i] - 1) == 0 for i in range(3)), "Blocked sites need power of two boxes"
+        bits = [box[i].bit_length() - 1 for i in range(3)]
+        self.sy, self.sz = bits[0], bits[0] + bits[1]
+        self.mx, self.my = box[0] - 1, box[1] - 1
+        self.nblocks = [box[i] >> 3 for i in range(3)]
+        self.rows = np.full(self.nblocks[0] * self.nblocks[1] * self.nblocks[2], -1, dtype=np.int32) # block -> row, -1 untouched
+        self.blocks = [] # row -> block
+        self.bitmaps = [] # row -> which of its 64 sites are taken
+        self.slots = np.full((capacity, 64), -1, dtype=np.int32)
+        self.count = 0
+
+    def locate(self, key):
+        # block number and which of its 64 sites key is, -1 if it isn't a diamond site
+        x, y, z = key & self.mx, key >> self.sy & self.my, key >> self.sz
+        block = ((x >> 3) * self.nblocks[1] + (y >> 3)) * self.nblocks[2] + (z >> 3)
+        return block, local_site[x & 7 | (y & 7) << 3 | (z & 7) << 6]
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        block, site = self.locate(key)
+        if site < 0:
+            return False
+        row = self.rows[block]
+        return row >= 0 and self.bitmaps[row] >> site & 1 == 1
+
+    def get(self, key, default=None):
+        block, site = self.locate(key)
+        if site < 0:
+            return default
+        row = self.rows[block]
+        if row < 0 or not self.bitmaps[row] >> site & 1:
+            return default
+        return int(self.slots[row, site])
+
+    def __getitem__(self, key):
+        slot = self.get(key)
+        if slot is None:
+            raise KeyError(key)
+        return slot
+
+    def __setitem__(self, key, slot):
+        block, site = self.locate(key)
+        if site < 0:
+            raise KeyError(f"{key} isn't a diamond site")
+        row = self.rows[block]
+        if row < 0:
+            row = len(self.blocks)
+            if row == len(self.slots):
+                self.slots = np.concatenate([self.slots, np.full_like(self.slots, -1)])
+            self.rows[block] = row
+            self.blocks.append(block)
+            self.bitmaps.append(0)
+        if not self.bitmaps[row] >> site & 1:
+            self.bitmaps[row] |= 1 << site
+            self.count += 1
+        self.slots[row, site] = slot
+
+    def pop(self, key, *default):
+        block, site = self.locate(key)
+        row = self.rows[block] if site >= 0 else -1
+        if row < 0 or not self.bitmaps[row] >> site & 1:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        slot = int(self.slots[row, site])
+        self.bitmaps[row] &= ~(1 << site)
+        self.slots[row, site] = -1
+        self.count -= 1
+        return slot
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def update(self, items):
+        for key, slot in items:
+            self[key] = slot
+
+    def set_many(self, keys, slots):
+        """self[key] = slot for an array of keys, none of them taken yet and no repeats"""
+        keys = np.asarray(keys, dtype=np.int64)
+        if not len(keys):
+            return
+        x, y, z = keys & self.mx, keys >> self.sy & self.my, keys >> self.sz
+        blocks = ((x >> 3) * self.nblocks[1] + (y >> 3)) * self.nblocks[2] + (z >> 3)
+        sites = local_sites[x & 7 | (y & 7) << 3 | (z & 7) << 6]
+        if (sites < 0).any():
+            raise KeyError(f"{keys[sites < 0][0]} isn't a diamond site")
+        fresh = np.unique(blocks[self.rows[blocks] < 0])
+        if len(fresh):
+            start = len(self.blocks)
+            if start + len(fresh) > len(self.slots):
+                # straight to the size needed, doubling there a step at a time copies it over and over
+                grown = np.full((max(2 * len(self.slots), start + len(fresh)), 64), -1, dtype=np.int32)
+                grown[:start] = self.slots[:start]
+                self.slots = grown
+            self.rows[fresh] = np.arange(start, start + len(fresh))
+            self.blocks.extend(fresh.tolist())
+            self.bitmaps.extend([0] * len(fresh))
+        rows = self.rows[blocks]
+        self.slots[rows, sites] = slots
+        # every row's new bits together, then one |= per row
+        order = np.argsort(rows, kind="stable")
+        rows, bits = rows[order], np.left_shift(np.uint64(1), sites[order].astype(np.uint64))
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        for row, bit in zip(rows[starts].tolist(), np.bitwise_or.reduceat(bits, starts).tolist()):
+            self.bitmaps[row] |= bit
+        self.count += len(keys)
+
+    def occupied(self):
+        # (keys, slots) of every taken site, block by block
+        rows, sites = np.nonzero(self.slots[:len(self.blocks)] >= 0)
+        blocks = np.array(self.blocks, dtype=np.int64)[rows]
+        bx, rest = np.divmod(blocks, self.nblocks[1] * self.nblocks[2])
+        by, bz = np.divmod(rest, self.nblocks[2])
+        local = block_sites[sites]
+        keys = (bx * 8 + local[:, 0]) | (by * 8 + local[:, 1]) << self.sy | (bz * 8 + local[:, 2]) << self.sz
+        return keys.tolist(), self.slots[rows, sites].tolist()
+
+    def keys(self):
+        return self.occupied()[0]
+
+    def values(self):
+        return self.occupied()[1]
+
+    def items(self):
+        return list(zip(*self.occupied()))
+
+    def __iter__(self):
+        return iter(self.keys())
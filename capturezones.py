@@ -0,0 +1,115 @@
+import math
+import numpy as np
+
+# which of the 8 sites in a 4x4x4 cube (x & 3) | (y & 3) << 2 | (z & 3) << 4 is, -1 if it isn't a diamond site
+def diamond(x, y, z):
+    return (x % 2 == y % 2 == z % 2 == 0 and (x + y + z) % 4 == 0) or (x % 2 == y % 2 == z % 2 == 1 and (x + y + z + 1) % 4 == 0)
+
+site_bit = np.full(64, -1, dtype=np.int64)
+site_bit[[i for i in range(64) if diamond(i & 3, i >> 2 & 3, i >> 4 & 3)]] = np.arange(8)
+
+
+class CaptureZones:
+    """
+    Says in O(1) whether anything could be within radius of a site, so most hops can skip the
+    neighbour search. Immobile defects stamp their zone into a bitmap (a bit per site), mobile
+    ones are counted in a grid of cells at least radius wide
+    """
+    def __init__(self, box, radius, mobile):
+        self.box = list(box)
+        self.radius = radius
+        self.mobile = mobile # by type code
+        self.bits = np.zeros([box[i] // 4 for i in range(3)], dtype=np.uint8)
+        # every offset within radius that lands on a site, starting from an even and from an odd site
+        r = int(radius)
+        span = np.arange(-r, r + 1)
+        cube = np.stack(np.meshgrid(span, span, span, indexing="ij"), axis=-1).reshape(-1, 3)
+        cube = cube[(cube * cube).sum(axis=1) <= radius * radius]
+        self.offsets = []
+        for start in (0, 1):
+            sites = (cube + start) % 4
+            self.offsets.append(cube[site_bit[sites[:, 0] | sites[:, 1] << 2 | sites[:, 2] << 4] >= 0])
+        self.ncells = [max(1, box[i] // max(1, math.ceil(radius))) for i in range(3)]
+        # a cell ~radius wide holds a few hundred sites at most, one defect to a site
+        self.crowd = np.zeros(self.ncells, dtype=np.uint16)
+
+    def cell(self, pos):
+        return tuple(pos[i] * self.ncells[i] // self.box[i] for i in range(3))
+
+    def locate(self, sites):
+        # cube and bit in it for every site
+        bits = (1 << site_bit[sites[:, 0] & 3 | (sites[:, 1] & 3) << 2 | (sites[:, 2] & 3) << 4]).astype(np.uint8)
+        return (sites[:, 0] >> 2, sites[:, 1] >> 2, sites[:, 2] >> 2), bits
+
+    def zone(self, pos):
+        return self.locate((np.array(pos) + self.offsets[pos[0] % 2]) % self.box)
+
+    def stamp(self, pos):
+        cubes, bits = self.zone(pos)
+        np.bitwise_or.at(self.bits, cubes, bits)
+
+    def add(self, pos, kind):
+        if self.mobile[kind]:
+            self.crowd[self.cell(pos)] += 1
+        else:
+            self.stamp(pos)
+
+    def add_many(self, sites, kind):
+        """add() for a batch of sites of one kind"""
+        sites = np.asarray(sites, dtype=np.int64)
+        if self.mobile[kind]:
+            np.add.at(self.crowd, tuple((sites * self.ncells // self.box).T), 1)
+            return
+        shape = np.array(self.bits.shape)
+        margin = int(self.radius) // 4 + 2 # cubes a zone can reach past its own
+        if len(sites) < 64 or (shape < margin).any():
+            for pos in sites.tolist():
+                self.stamp(pos)
+            return
+        # stamped into a copy padded out by margin cubes all round so no offset has to wrap,
+        # the padding is folded back onto the far side of the box at the end
+        padded = np.zeros(shape + 2 * margin, dtype=np.uint8)
+        strides = np.array([padded.shape[1] * padded.shape[2], padded.shape[2], 1])
+        flat = padded.reshape(-1)
+        places = sites[:, 0] & 3 | (sites[:, 1] & 3) << 2 | (sites[:, 2] & 3) << 4
+        for place in np.unique(places).tolist():
+            where = np.array([place & 3, place >> 2 & 3, place >> 4 & 3])
+            # sites in the same place in their cube see every offset land on the same bit of the
+            # same neighbouring cube, so all the offsets into one cube make a single |= of a constant
+            starts = ((sites[places == place] >> 2) + margin) @ strides
+            targets = where + self.offsets[where[0] % 2]
+            jumps, into = np.unique((targets >> 2) @ strides, return_inverse=True)
+            masks = np.zeros(len(jumps), dtype=np.uint8)
+            np.bitwise_or.at(masks, into, (1 << site_bit[targets[:, 0] & 3 | (targets[:, 1] & 3) << 2 | (targets[:, 2] & 3) << 4]).astype(np.uint8))
+            for jump, mask in zip(jumps.tolist(), masks.tolist()):
+                flat[starts + jump] |= mask
+        for axis in range(3):
+            side = np.moveaxis(padded, axis, 0)
+            n = shape[axis]
+            side[n:n + margin] |= side[:margin]
+            side[margin:2 * margin] |= side[n + margin:]
+        self.bits |= padded[margin:-margin, margin:-margin, margin:-margin]
+
+    def remove(self, pos, kind, cells, store):
+        """pos has to be off cells already, the traps still in it near pos get their zones back"""
+        if self.mobile[kind]:
+            self.crowd[self.cell(pos)] -= 1
+            return
+        cubes, bits = self.zone(pos)
+        np.bitwise_and.at(self.bits, cubes, ~bits)
+        for site, slot in cells.sites_within(pos, 2 * self.radius):
+            if not self.mobile[store.kind[slot]]:
+                self.stamp(site)
+
+    def clear(self, pos):
+        """Whether there's nothing within radius of pos but the one mobile defect sitting on it"""
+        x, y, z = pos
+        if self.bits[x >> 2, y >> 2, z >> 2] >> site_bit[x & 3 | (y & 3) << 2 | (z & 3) << 4] & 1:
+            return False
+        c = self.cell(pos)
+        if all(0 < c[i] < self.ncells[i] - 1 for i in range(3)):
+            around = self.crowd[c[0] - 1:c[0] + 2, c[1] - 1:c[1] + 2, c[2] - 1:c[2] + 2]
+        else:
+            # round the edge of the box, tiny boxes count the same cell more than once which only ever says no
+            around = self.crowd[np.ix_(*[np.arange(c[i] - 1, c[i] + 2) % self.ncells[i] for i in range(3)])]
+        return around.sum() <= 1
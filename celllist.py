@@ -0,0 +1,223 @@
+import math
+import numpy as np
+
+class CellList:
+    """
+    Linked cells about cell_size wide over a periodic box, for neighbour queries
+    """
+    def __init__(self, box, cell_size=8, capacity=1024):
+        self.box = list(box)
+        self.ncells = [max(1, self.box[i] // cell_size) for i in range(3)]
+        self.width = [self.box[i] / self.ncells[i] for i in range(3)]
+        # first entry in every cell, -1 for empty, then each entry's site (packed), item and the next entry in its cell
+        self.head = np.full(self.ncells[0] * self.ncells[1] * self.ncells[2], -1, dtype=np.int32)
+        self.sites = np.zeros(capacity, dtype=np.int64)
+        self.items = np.zeros(capacity, dtype=np.int32)
+        self.next = np.full(capacity, -1, dtype=np.int32)
+        self.used = 0
+        self.free = -1 # entries given back, chained through self.next
+        self.rings = [] # cached cell offsets at each chebyshev distance
+
+    def cell(self, pos):
+        return tuple(int(pos[i] % self.box[i] * self.ncells[i] // self.box[i]) for i in range(3))
+
+    def index(self, cell):
+        return (cell[0] * self.ncells[1] + cell[1]) * self.ncells[2] + cell[2]
+
+    def site(self, pos):
+        # sites are kept wrapped so the same site always has the same entry however it was reached
+        return tuple(pos[i] % self.box[i] for i in range(3))
+
+    def pack(self, site):
+        return (site[0] * self.box[1] + site[1]) * self.box[2] + site[2]
+
+    def unpack(self, code):
+        rest, z = divmod(code, self.box[2])
+        x, y = divmod(rest, self.box[1])
+        return (x, y, z)
+
+    def grow(self):
+        self.sites = np.concatenate([self.sites, np.zeros_like(self.sites)])
+        self.items = np.concatenate([self.items, np.zeros_like(self.items)])
+        self.next = np.concatenate([self.next, np.full_like(self.next, -1)])
+
+    def entry(self):
+        # a free entry, reusing given back ones first
+        if self.free >= 0:
+            e = self.free
+            self.free = int(self.next[e])
+            self.next[e] = -1
+            return e
+        if self.used == len(self.sites):
+            self.grow()
+        self.used += 1
+        return self.used - 1
+
+    def insert(self, pos, item):
+        c = self.index(self.cell(pos))
+        code = self.pack(self.site(pos))
+        # new entries go on the end so a cell comes out in the order it was filled
+        last = -1
+        e = int(self.head[c])
+        while e >= 0:
+            if self.sites[e] == code:
+                self.items[e] = item
+                return
+            last, e = e, int(self.next[e])
+        e = self.entry()
+        self.sites[e] = code
+        self.items[e] = item
+        if last < 0:
+            self.head[c] = e
+        else:
+            self.next[last] = e
+
+    def insert_many(self, sites, items):
+        """insert() for an (n, 3) array of sites nobody's on yet"""
+        sites = np.asarray(sites, dtype=np.int64) % self.box
+        cells = self.index((sites * self.ncells // self.box).T)
+        order = np.argsort(cells, kind="stable")
+        cells = cells[order]
+        n = len(cells)
+        while self.used + n > len(self.sites):
+            self.grow()
+        entries = np.arange(self.used, self.used + n)
+        self.used += n
+        self.sites[entries] = self.pack(sites[order].T)
+        self.items[entries] = np.asarray(items)[order]
+        # chain each cell's new entries together in order, the first of them hangs off the old tail
+        last = np.ones(n, dtype=bool)
+        last[:-1] = cells[1:] != cells[:-1]
+        self.next[entries[~last]] = entries[1:][~last[:-1]]
+        first = np.ones(n, dtype=bool)
+        first[1:] = cells[1:] != cells[:-1]
+        cells, entries = cells[first], entries[first]
+        empty = self.head[cells] < 0
+        self.head[cells[empty]] = entries[empty]
+        for c, e in zip(cells[~empty].tolist(), entries[~empty].tolist()):
+            tail = int(self.head[c])
+            while self.next[tail] >= 0:
+                tail = int(self.next[tail])
+            self.next[tail] = e
+
+    def remove(self, pos):
+        c = self.index(self.cell(pos))
+        code = self.pack(self.site(pos))
+        prev = -1
+        e = int(self.head[c])
+        while self.sites[e] != code:
+            prev, e = e, int(self.next[e])
+            if e < 0:
+                raise KeyError(pos)
+        if prev < 0:
+            self.head[c] = self.next[e]
+        else:
+            self.next[prev] = self.next[e]
+        self.next[e] = self.free
+        self.free = e
+
+    def contents(self, c):
+        # (site, item) for everything in cell c
+        found = []
+        e = int(self.head[c])
+        while e >= 0:
+            found.append((self.unpack(int(self.sites[e])), int(self.items[e])))
+            e = int(self.next[e])
+        return found
+
+    def ring(self, k):
+        # offsets of every cell whose chebyshev distance from the centre cell is exactly k
+        while len(self.rings) <= k:
+            n = len(self.rings)
+            self.rings.append([(i, j, l) for i in range(-n, n+1) for j in range(-n, n+1) for l in range(-n, n+1)
+                               if max(abs(i), abs(j), abs(l)) == n])
+        return self.rings[k]
+
+    def distance(self, pos1, pos2):
+        # minimum image distance
+        d2 = 0
+        for i in range(3):
+            d = (pos2[i] - pos1[i]) % self.box[i]
+            if d > self.box[i] / 2:
+                d -= self.box[i]
+            d2 += d * d
+        return math.sqrt(d2)
+
+    def shells(self, pos, radius):
+        """Yields (k, items) for each ring of cells around pos, stopping once a ring can't reach radius"""
+        c = self.cell(pos)
+        kmax = int(radius // min(self.width)) + 1
+        if kmax > 1:
+            yield from self.wide_shells(c, kmax)
+            return
+        seen = set()
+        for k in range(kmax + 1):
+            found = []
+            for off in self.ring(k):
+                cell = tuple((c[i] + off[i]) % self.ncells[i] for i in range(3))
+                # small boxes wrap around onto themselves, don't look at a cell twice
+                if cell in seen:
+                    continue
+                seen.add(cell)
+                found.extend(self.contents(self.index(cell)))
+            yield k, found
+
+    def wide_shells(self, c, kmax):
+        # same as shells() but the whole cube of cells is checked for an empty head in one go,
+        # only the cells with something in them are looked up. Comes out in the same order
+        span = np.arange(-kmax, kmax + 1)
+        # only the cube around c is looked at, anything over the whole box makes every search O(volume)
+        cube = self.head.reshape(self.ncells)[np.ix_(*[(c[i] + span) % self.ncells[i] for i in range(3)])] >= 0
+        offsets = np.argwhere(cube) - kmax
+        rings = np.abs(offsets).max(axis=1)
+        order = np.argsort(rings, kind="stable")
+        offsets, rings = offsets[order].tolist(), rings[order].tolist()
+        seen = set()
+        n = 0
+        for k in range(kmax + 1):
+            found = []
+            while n < len(rings) and rings[n] == k:
+                off = offsets[n]
+                n += 1
+                cell = tuple((c[i] + off[i]) % self.ncells[i] for i in range(3))
+                if cell in seen:
+                    continue
+                seen.add(cell)
+                found.extend(self.contents(self.index(cell)))
+            yield k, found
+
+    def nearest(self, pos, radius, exclude=None):
+        """Returns [item, d] for the closest item within radius of pos, [] if there isn't one"""
+        best = []
+        best_key = None
+        wmin = min(self.width)
+        for k, found in self.shells(pos, radius):
+            for site, item in found:
+                if item == exclude:
+                    continue
+                d = self.distance(pos, site)
+                # ties are broken on the site so the answer doesn't depend on insertion order
+                if d <= radius and (best_key is None or (d, site) < best_key):
+                    best_key = (d, site)
+                    best = [item, d]
+            # every cell further out is at least k cell widths away
+            if best_key is not None and best_key[0] <= k * wmin:
+                break
+        return best
+
+    def within(self, pos, radius, exclude=None):
+        """Returns [item, d] for every item within radius of pos"""
+        neighbours = []
+        for k, found in self.shells(pos, radius):
+            for site, item in found:
+                if item == exclude:
+                    continue
+                d = self.distance(pos, site)
+                if d <= radius:
+                    neighbours.append([item, d])
+        return neighbours
+
+    def sites_within(self, pos, radius):
+        """Returns (site, item) for every site within radius of pos, multi-site items come up once per site"""
+        return [(site, item) for k, found in self.shells(pos, radius) for site, item in found
+                if self.distance(pos, site) <= radius]
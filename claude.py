@@ -1,9 +1,11 @@
 import numpy as np
 from collections import defaultdict
 from scipy.spatial import cKDTree
+from sumtree import RateTree
+from ratecache import RateCache
 
 class DefectKMC:
-    def __init__(self, box_dimensions, cutoff_radius, temperature):
+    def __init__(self, box_dimensions, cutoff_radius, temperature, skin=2.0, rate_resolution=None):
         """
         Initialize the KMC simulation.
         
@@ -15,18 +17,46 @@ class DefectKMC:
             Interaction radius for defect-defect interactions
         temperature : float
             Simulation temperature in Kelvin
+        skin : float
+            Extra reach of the neighbor list past the cutoff
+        rate_resolution : float or None
+            If set, rates are cached by energy rounded to this many eV, see RateCache
         """
         self.box = np.array(box_dimensions)
         self.cutoff = cutoff_radius
         self.temperature = temperature
         self.kb = 8.617333262e-5  # Boltzmann constant in eV/K
+        self.v0 = 1e13  # Attempt frequency (typical phonon frequency), in Hz
+        self.rate_cache = RateCache(self.v0, self.kb, rate_resolution) if rate_resolution is not None else None
         
         # Store defects as a dictionary: {defect_id: {'position': array, 'type': str, 'properties': dict}}
         self.defects = {}
         self.defect_counter = 0
         
-        # Neighbor list for efficient interaction calculations
+        # The same positions and types as dense arrays indexed by defect ID, types as integer
+        # codes into a symmetric matrix of interaction prefactors, for vectorised energies
+        self.positions = np.zeros((64, 3))
+        self.codes = np.zeros(64, dtype=np.int64)
+        self.type_codes = {}
+        self.interaction_prefactors = np.zeros((0, 0))
+        
+        # Verlet neighbor list: every pair within cutoff + skin when it was built
         self.neighbor_list = None
+        self.skin = skin
+        # Positions at the last build, to tell how far each defect has moved since
+        self.reference_positions = {}
+        self.neighbor_rebuilds = 0
+        # Each defect's neighbors as an index array, made when first needed after the list changes
+        self.neighbor_arrays = {}
+        
+        # Persistent event catalog: every jump of every defect keeps a slot in a rate sum tree,
+        # and only defects whose rates could have changed since the last step are recomputed
+        self.rates = RateTree()
+        self.events = []  # slot -> (defect_id, destination)
+        self.defect_slots = defaultdict(list)  # defect_id -> its slots
+        self.free_slots = []
+        self.stale = set()  # defects whose events need recomputing before the next step
+        self.all_stale = False  # set when we can't tell which defects a change touched
         
     def add_defect(self, position, defect_type, properties=None):
         """Add a defect to the simulation."""
@@ -47,13 +77,58 @@ class DefectKMC:
         defect_id = self.defect_counter
         self.defect_counter += 1
         
-        # Neighbor list is now outdated
-        self.neighbor_list = None
+        # Mirror it into the dense arrays, doubling them when they're full
+        if defect_id == len(self.positions):
+            self.positions = np.concatenate([self.positions, np.zeros_like(self.positions)])
+            self.codes = np.concatenate([self.codes, np.zeros_like(self.codes)])
+        self.positions[defect_id] = position
+        self.codes[defect_id] = self._get_type_code(defect_type)
+        
+        # Add the new defect's pairs to the neighbor list in place rather than throwing it away
+        # and mark everything it interacts with for a rate update
+        self.stale.add(defect_id)
+        if self.neighbor_list is not None:
+            self._insert_neighbors(defect_id)
+            self.stale.update(self.neighbor_list.get(defect_id, []))
+        else:
+            self.all_stale = True
         
         return defect_id
+
+    def _get_type_code(self, defect_type):
+        """Integer code for a defect type, growing the prefactor matrix the first time it's seen."""
+        code = self.type_codes.get(defect_type)
+        if code is None:
+            code = len(self.type_codes)
+            self.type_codes[defect_type] = code
+            types = list(self.type_codes)
+            self.interaction_prefactors = np.array([[self._get_interaction_prefactor(type1, type2) for type2 in types]
+                                                    for type1 in types])
+        return code
+
+    def _minimum_image(self, vec):
+        """Shortest periodic image of a separation vector (or array of them)."""
+        return vec - self.box * np.round(vec / self.box)
+
+    def _insert_neighbors(self, defect_id):
+        """Add one defect to the existing neighbor list, checking it against every other defect."""
+        position = self.defects[defect_id]['position']
+        ids = [other_id for other_id in self.defects if other_id != defect_id]
+        self.reference_positions[defect_id] = position.copy()
+        if not ids:
+            return
+            
+        # Compare against where the others were at the last build, like the rest of the list
+        others = np.array([self.reference_positions[other_id] for other_id in ids])
+        distances = np.linalg.norm(self._minimum_image(others - position), axis=1)
+        for index in np.nonzero(distances <= self.cutoff + self.skin)[0]:
+            self.neighbor_list[defect_id].append(ids[index])
+            self.neighbor_list[ids[index]].append(defect_id)
+            self.neighbor_arrays.pop(ids[index], None)
+        self.neighbor_arrays.pop(defect_id, None)
     
     def update_neighbor_list(self):
-        """Update the neighbor list for efficient interaction calculations."""
+        """Rebuild the Verlet neighbor list (every pair within cutoff + skin) from scratch."""
         if not self.defects:
             self.neighbor_list = None
             return
@@ -61,12 +136,15 @@ class DefectKMC:
         # Get positions and IDs
         positions = np.array([self.defects[defect_id]['position'] for defect_id in self.defects])
         ids = list(self.defects.keys())
+        self.reference_positions = {defect_id: position.copy() for defect_id, position in zip(ids, positions)}
+        self.neighbor_rebuilds += 1
+        self.neighbor_arrays = {}
         
         # Build KD-tree for efficient nearest neighbor search
         tree = cKDTree(positions, boxsize=self.box)
         
-        # Find all pairs within cutoff radius
-        pairs = tree.query_pairs(self.cutoff)
+        # Find all pairs within cutoff radius plus the skin
+        pairs = tree.query_pairs(self.cutoff + self.skin)
         
         # Build neighbor dictionary
         self.neighbor_list = defaultdict(list)
@@ -79,34 +157,38 @@ class DefectKMC:
         Calculate migration energy for a defect to move to a new position,
         accounting for interactions with nearby defects.
         """
+        return self.get_migration_energies(defect_id, [destination])[0]
+    
+    def get_migration_energies(self, defect_id, destinations):
+        """
+        Migration energies for a defect to each of several destinations, as an array.
+        Override this rather than get_migration_energy for your physical model.
+        """
         if self.neighbor_list is None:
             self.update_neighbor_list()
             
-        defect = self.defects[defect_id]
-        defect_type = defect['type']
-        current_pos = defect['position']
-        
         # Base migration energy (depends on defect type)
-        base_energy = self._get_base_migration_energy(defect_type)
+        base_energy = self._get_base_migration_energy(self.defects[defect_id]['type'])
         
         # Calculate energy modification due to nearby defects
         energy_modifier = 0.0
-        
-        for neighbor_id in self.neighbor_list.get(defect_id, []):
-            neighbor = self.defects[neighbor_id]
-            neighbor_type = neighbor['type']
-            neighbor_pos = neighbor['position']
+        neighbor_ids = self.neighbor_arrays.get(defect_id)
+        if neighbor_ids is None:
+            neighbor_ids = np.array(self.neighbor_list.get(defect_id, []), dtype=np.int64)
+            self.neighbor_arrays[defect_id] = neighbor_ids
             
-            # Calculate distance with periodic boundary conditions
-            vec = neighbor_pos - current_pos
-            vec = vec - self.box * np.round(vec / self.box)
-            distance = np.linalg.norm(vec)
+        if len(neighbor_ids):
+            # Squared distances with periodic boundary conditions to every neighbor at once
+            vec = self._minimum_image(self.positions[neighbor_ids] - self.positions[defect_id])
+            distance_sq = np.einsum('ij,ij->i', vec, vec)
             
-            # Apply interaction model (this is where your physics model comes in)
-            interaction = self._get_interaction_energy(defect_type, neighbor_type, distance)
-            energy_modifier += interaction
+            # The list reaches out to cutoff + skin, only pairs inside the cutoff interact,
+            # and coincident pairs are skipped like in _get_interaction_energy
+            inside = (distance_sq <= self.cutoff * self.cutoff) & (distance_sq >= 1e-20)
+            prefactors = self.interaction_prefactors[self.codes[defect_id], self.codes[neighbor_ids[inside]]]
+            energy_modifier = np.sum(prefactors / distance_sq[inside])
             
-        return base_energy + energy_modifier
+        return np.full(len(destinations), base_energy + energy_modifier)
     
     def _get_base_migration_energy(self, defect_type):
         """
@@ -130,6 +212,14 @@ class DefectKMC:
         if distance < 1e-10:
             return 0.0  # Avoid division by zero
             
+        # Simple interaction model (replace with your physics)
+        return self._get_interaction_prefactor(defect_type1, defect_type2) / (distance * distance)
+    
+    def _get_interaction_prefactor(self, defect_type1, defect_type2):
+        """
+        Prefactor of the inverse square interaction between two defect types.
+        Override this method with your physical model.
+        """
         # Example interaction parameters - replace with your physical model
         interaction_matrix = {
             ('vacancy', 'vacancy'): 0.1,
@@ -150,52 +240,26 @@ class DefectKMC:
         else:
             param = 0.05  # Default
             
-        # Simple interaction model (replace with your physics)
-        return param / (distance * distance)
+        return param
     
     def run_kmc_step(self):
         """Perform a single KMC step."""
         if not self.defects:
             return None
             
-        # Calculate rates for all possible events
-        events = []
-        rates = []
-        
-        # For each defect, consider possible jumps (to nearest neighbor sites)
-        for defect_id, defect in self.defects.items():
-            current_pos = defect['position']
-            
-            # Generate possible jump destinations (nearest neighbors on the lattice)
-            # This will depend on your lattice structure
-            possible_jumps = self._get_possible_jumps(defect_id)
-            
-            for dest in possible_jumps:
-                # Calculate migration energy and rate
-                e_mig = self.get_migration_energy(defect_id, dest)
-                rate = self._get_rate(e_mig)
-                
-                if rate > 0:
-                    events.append((defect_id, dest))
-                    rates.append(rate)
+        # Bring the rates of everything touched by the last move up to date
+        self._refresh_events()
+        total_rate = self.rates.total()
         
         # If no events are possible, return
-        if not events:
+        if total_rate <= 0:
             return None
             
-        # Convert to numpy array for efficient operations
-        rates = np.array(rates)
-        
-        # Calculate cumulative rates
-        cumulative_rates = np.cumsum(rates)
-        total_rate = cumulative_rates[-1]
-        
         # Choose an event with probability proportional to its rate
         rand = np.random.random() * total_rate
-        event_index = np.searchsorted(cumulative_rates, rand)
+        chosen_defect, destination = self.events[self.rates.find(rand)]
         
         # Execute the chosen event
-        chosen_defect, destination = events[event_index]
         self._move_defect(chosen_defect, destination)
         
         # Time increment (exponential distribution)
@@ -203,6 +267,39 @@ class DefectKMC:
         
         return dt
     
+    def _refresh_events(self):
+        """Recompute the jumps and rates of every stale defect and write them into the rate tree."""
+        if self.all_stale:
+            self.stale = set(self.defects)
+            self.all_stale = False
+        if self.neighbor_list is None:
+            self.update_neighbor_list()
+            
+        for defect_id in self.stale:
+            slots = self.defect_slots[defect_id]
+            jumps = self._get_possible_jumps(defect_id)
+            
+            # Jumps keep their slots from one update to the next, only new ones need a slot
+            while len(slots) < len(jumps):
+                if self.free_slots:
+                    slot = self.free_slots.pop()
+                else:
+                    slot = len(self.events)
+                    self.events.append(None)
+                slots.append(slot)
+            while len(slots) > len(jumps):
+                slot = slots.pop()
+                self.rates.set(slot, 0.0)
+                self.events[slot] = None
+                self.free_slots.append(slot)
+                
+            # Calculate migration energies and rates for every jump at once
+            rates = self._get_rate(self.get_migration_energies(defect_id, jumps))
+            for slot, dest, rate in zip(slots, jumps, rates.tolist()):
+                self.events[slot] = (defect_id, dest)
+                self.rates.set(slot, max(rate, 0.0))
+        self.stale = set()
+    
     def _get_possible_jumps(self, defect_id):
         """
         Get possible jump destinations for a defect.
@@ -226,30 +323,47 @@ class DefectKMC:
         return jumps
     
     def _get_rate(self, energy):
-        """Calculate transition rate using Arrhenius equation."""
+        """Calculate transition rate using Arrhenius equation, for one energy or an array of them."""
+        # Quantised and memoised unless the cache is switched off
+        if self.rate_cache is not None:
+            if np.ndim(energy):
+                return self.rate_cache.rates(energy, self.temperature)
+            return self.rate_cache.rate(energy, self.temperature)
         # v0 * exp(-E/kT)
-        v0 = 1e13  # Attempt frequency (typical phonon frequency), in Hz
-        return v0 * np.exp(-energy / (self.kb * self.temperature))
+        return self.v0 * np.exp(-energy / (self.kb * self.temperature))
     
     def _move_defect(self, defect_id, new_position):
         """Move a defect to a new position."""
         if defect_id in self.defects:
+            # Only the defect itself and whatever is within the cutoff of where it was or where
+            # it's going can see a different energy, the neighbor list covers both
+            if self.neighbor_list is None:
+                self.update_neighbor_list()
+            self.stale.add(defect_id)
+            self.stale.update(self.neighbor_list.get(defect_id, []))
+            
             self.defects[defect_id]['position'] = new_position
+            self.positions[defect_id] = new_position
             
-            # Neighbor list is now outdated
-            self.neighbor_list = None
+            # The neighbor list only goes out of date once this defect has moved more than
+            # skin / 2 from where it was when the list was built
+            moved = self._minimum_image(new_position - self.reference_positions[defect_id])
+            if np.linalg.norm(moved) > self.skin / 2:
+                self.update_neighbor_list()
+            self.stale.update(self.neighbor_list.get(defect_id, []))
 
-# Create simulation
-sim = DefectKMC(box_dimensions=(100, 100, 100), cutoff_radius=5.0, temperature=500)
+if __name__ == "__main__":
+    # Create simulation
+    sim = DefectKMC(box_dimensions=(100, 100, 100), cutoff_radius=5.0, temperature=500)
 
-# Add defects
-sim.add_defect([25, 25, 25], 'vacancy')
-sim.add_defect([30, 30, 30], 'interstitial')
+    # Add defects
+    sim.add_defect([25, 25, 25], 'vacancy')
+    sim.add_defect([30, 30, 30], 'interstitial')
 
-# Run simulation for 1000 steps
-time = 0
-for _ in range(1000):
-    dt = sim.run_kmc_step()
-    if dt is not None:
-        time += dt
-    print(f"Simulation time: {time} seconds")
+    # Run simulation for 1000 steps
+    time = 0
+    for _ in range(1000):
+        dt = sim.run_kmc_step()
+        if dt is not None:
+            time += dt
+        print(f"Simulation time: {time} seconds")
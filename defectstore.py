@@ -0,0 +1,64 @@
+import numpy as np
+
+class DefectStore:
+    """
+    Every defect on a lattice as one row per slot: pos, kind (type code, 0 is empty) and rate.
+    Freed slots get reused first, the extra sites of complexes go in extra
+    """
+    def __init__(self, capacity=1024):
+        self.pos = np.zeros((capacity, 3), dtype=np.int32)
+        self.kind = np.zeros(capacity, dtype=np.uint8)
+        self.rate = np.zeros(capacity)
+        self.extra = {} # slot -> {attribute: value}
+        self.size = 0 # every slot below this has been handed out at some point
+        self.free_slots = []
+
+    def __len__(self):
+        return self.size - len(self.free_slots)
+
+    def grow(self):
+        capacity = 2 * len(self.kind)
+        self.pos = np.resize(self.pos, (capacity, 3))
+        self.kind = np.resize(self.kind, capacity)
+        self.rate = np.resize(self.rate, capacity)
+        # np.resize repeats the old data into the new space, blank it
+        self.kind[capacity // 2:] = 0
+        self.rate[capacity // 2:] = 0
+
+    def alloc(self, pos, kind, rate, extra=None):
+        if self.free_slots:
+            slot = self.free_slots.pop()
+        else:
+            slot = self.size
+            if slot >= len(self.kind):
+                self.grow()
+            self.size += 1
+        self.pos[slot] = pos
+        self.kind[slot] = kind
+        self.rate[slot] = rate
+        if extra:
+            self.extra[slot] = extra
+        return slot
+
+    def alloc_many(self, pos, kind, rate):
+        """alloc() for a batch of single site defects of one kind, returns their slots"""
+        reused = [self.free_slots.pop() for i in range(min(len(pos), len(self.free_slots)))]
+        new = len(pos) - len(reused)
+        while self.size + new > len(self.kind):
+            self.grow()
+        slots = np.concatenate([np.array(reused, dtype=np.int64), np.arange(self.size, self.size + new)])
+        self.size += new
+        self.pos[slots] = pos
+        self.kind[slots] = kind
+        self.rate[slots] = rate
+        return slots
+
+    def free(self, slot):
+        self.kind[slot] = 0
+        self.rate[slot] = 0
+        self.extra.pop(slot, None)
+        self.free_slots.append(slot)
+
+    def live(self):
+        """Indices of every occupied slot"""
+        return np.flatnonzero(self.kind[:self.size])
@@ -0,0 +1,137 @@
+"""
+Runs many independent replicas of the new3.py anneal over a process pool and averages the
+populations on a common time grid.
+Usage: python ensemble.py --replicas 32 --T 1100 --N 160 --V 40 --box 256 --time 10 --points 50
+"""
+import argparse
+import json
+import statistics
+import time as clock
+import multiprocessing as mp
+import numpy as np
+import new3
+from new3 import Lattice, Vacancy, Nitrogen, defect_types, ppm_to_num
+from trajectory import BinaryTrajectoryWriter
+from schedule import Schedule
+
+names = [cls.__name__ for cls in defect_types if cls is not None]
+codes = [cls.code for cls in defect_types if cls is not None]
+
+def run_replica(replica, seed, params, times, queue):
+    """One replica, sends (replica, grid index, counts) for every point of times as it gets there
+    and (replica, None, summary) when it's done"""
+    lattice = Lattice([params["box"]] * 3, seed=seed, temperature=params["T"], **params["lattice"])
+    lattice.populate(Vacancy, ppm_to_num(params["V_ppm"], lattice), "gaussian", sigma=params["sigma"])
+    lattice.populate(Nitrogen, ppm_to_num(params["N_ppm"], lattice))
+    trajectory = params["trajectory"]
+    if trajectory is not None:
+        path = f"{params['prefix']}_{replica}.{'kmct' if trajectory == 'binary' else 'extxyz'}"
+        lattice.output = path
+        if trajectory == "binary":
+            lattice.writer = BinaryTrajectoryWriter(path, lattice.box)
+    start = clock.perf_counter()
+    for i, t in enumerate(times):
+        # step right up to t, the populations at t are whatever they were after the last event before it
+        while lattice.step(until=t) is not None:
+            pass
+        queue.put((replica, i, lattice.counts[:]))
+        if trajectory is not None and i % params["frame_every"] == 0:
+            lattice.write_atoms()
+    lattice.close()
+    queue.put((replica, None, {"steps": lattice.steps, "seconds": clock.perf_counter() - start}))
+
+
+class Ensemble:
+    """
+    Replicas of one (T, N_ppm, V_ppm) point over a process pool, replica i seeded with
+    SeedSequence(seed).spawn(replicas)[i]. trajectory is None, "extxyz" or "binary"
+    """
+    def __init__(self, replicas=16, T=1100, N_ppm=160, V_ppm=40, box=256, sigma=None, seed=None,
+                 trajectory=None, prefix="replica", frame_every=1, **lattice_options):
+        self.replicas = replicas
+        self.seed = np.random.SeedSequence(seed).entropy # kept so the whole ensemble can be repeated
+        self.params = {"T": T, "N_ppm": N_ppm, "V_ppm": V_ppm, "box": box, "sigma": sigma if sigma is not None else box / 16,
+                       "trajectory": trajectory, "prefix": prefix, "frame_every": frame_every, "lattice": lattice_options}
+
+    def run(self, times, processes=None, confidence=0.95):
+        """Runs every replica through times (seconds of simulated time, increasing) and returns
+        the aggregate, see summary()"""
+        times = np.asarray(times, dtype=float)
+        self.times = times
+        self.n = np.zeros(len(times), dtype=np.int64)
+        self.sums = np.zeros((len(times), len(defect_types)))
+        self.squares = np.zeros((len(times), len(defect_types)))
+        self.replica_stats = {}
+        seeds = np.random.SeedSequence(self.seed).spawn(self.replicas)
+        start = clock.perf_counter()
+        with mp.Manager() as manager, mp.Pool(processes) as pool:
+            queue = manager.Queue()
+            jobs = [pool.apply_async(run_replica, (replica, seeds[replica], self.params, times, queue))
+                    for replica in range(self.replicas)]
+            while len(self.replica_stats) < self.replicas:
+                try:
+                    replica, i, counts = queue.get(timeout=1)
+                except Exception:
+                    for job in jobs:
+                        if job.ready():
+                            job.get() # raises whatever the worker raised
+                    continue
+                if i is None:
+                    self.replica_stats[replica] = counts
+                    continue
+                counts = np.array(counts)
+                self.n[i] += 1
+                self.sums[i] += counts
+                self.squares[i] += counts * counts
+        self.wall = clock.perf_counter() - start
+        return self.summary(confidence)
+
+    def summary(self, confidence=0.95):
+        """{"times", "n", then for every defect type its mean, std and the lower and upper edge
+        of the confidence band on the mean}, normal approximation so trust it from ~10 replicas"""
+        n = np.maximum(self.n, 1)[:, None]
+        mean = self.sums / n
+        var = np.maximum(self.squares / n - mean * mean, 0) * n / np.maximum(n - 1, 1)
+        std = np.sqrt(var)
+        z = statistics.NormalDist().inv_cdf(0.5 + confidence / 2)
+        half = z * std / np.sqrt(n)
+        result = {"times": self.times.tolist(), "n": self.n.tolist(), "confidence": confidence}
+        for name, code in zip(names, codes):
+            result[name] = {"mean": mean[:, code].tolist(), "std": std[:, code].tolist(),
+                            "lo": (mean[:, code] - half[:, code]).tolist(), "hi": (mean[:, code] + half[:, code]).tolist()}
+        return result
+
+    def save(self, path, confidence=0.95):
+        with open(path, "w") as f:
+            T = self.params["T"]
+            params = dict(self.params, T=T.get_state() if isinstance(T, Schedule) else T)
+            json.dump({"params": params, "replicas": self.replicas, "seed": self.seed,
+                       "replica_stats": self.replica_stats, "summary": self.summary(confidence)}, f)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, default=16)
+    parser.add_argument("--T", type=float, default=new3.T)
+    parser.add_argument("--N", type=float, default=new3.N_ppm, help="nitrogen ppm")
+    parser.add_argument("--V", type=float, default=new3.V_ppm, help="vacancy ppm")
+    parser.add_argument("--box", type=int, default=256)
+    parser.add_argument("--time", type=float, default=1.0, help="simulated seconds per replica")
+    parser.add_argument("--points", type=int, default=50, help="points on the common time grid")
+    parser.add_argument("--procs", type=int, default=None, help="pool size, every core by default")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--trajectory", choices=["extxyz", "binary"], default=None)
+    parser.add_argument("--first-passage", action="store_true")
+    parser.add_argument("--out", default="ensemble.json")
+    args = parser.parse_args()
+
+    ensemble = Ensemble(args.replicas, args.T, args.N, args.V, args.box, seed=args.seed, trajectory=args.trajectory,
+                        first_passage=args.first_passage)
+    print("seed:", ensemble.seed)
+    result = ensemble.run(np.linspace(0, args.time, args.points + 1)[1:], args.procs)
+    ensemble.save(args.out)
+    steps = sum(stats["steps"] for stats in ensemble.replica_stats.values())
+    print(f"{args.replicas} replicas, {steps} steps in {ensemble.wall:.1f} s")
+    for name in ("Vacancy", "NitrogenVacancy", "VacancyCluster"):
+        print(f"{name}: {result[name]['mean'][-1]:.2f} ({result[name]['lo'][-1]:.2f} - {result[name]['hi'][-1]:.2f})"
+              f" at {result['times'][-1]} s")
@@ -0,0 +1,171 @@
+import heapq
+import math
+import numpy as np
+from celllist import CellList
+
+class Walk:
+    # one vacancy out on a first passage walk, the path itself is never kept, it's redrawn from seed
+    __slots__ = ('t0', 'seed', 'radius', 'odd', 'rate', 'hops', 'exit', 't_exit')
+
+
+class FirstPassage:
+    """
+    Vacancies with nothing around them walk straight to the edge of an empty sphere in one go,
+    drawn from a generator seeded per walk so a walk that gets disrupted can be replayed to where
+    it had got to. Anything that adds defects or changes rates by hand should disrupt() the area first
+    """
+    def __init__(self, box, capture_radius, moves, max_radius=24, min_radius=2):
+        # a domain plus the one it's next to has to fit in half the box or minimum image gets confused
+        self.max_radius = min(max_radius, int((min(box) / 2 - capture_radius - 4) / 2))
+        self.min_radius = min_radius # anything smaller costs more to set up than hopping it
+        self.capture_radius = capture_radius
+        self.moves = np.array(moves) # the even sublattice moves, odd sites use minus these
+        self.domains = CellList(box, 2 * self.max_radius + capture_radius + 4)
+        self.walks = {} # slot -> Walk
+        self.events = [] # (landing time, slot) heap, walks that get cut short are skipped when popped
+        self.hops = 0 # hops stood in for by walks that have landed or been cut short
+
+    def chunks(self, walk):
+        """Yields (offsets from the start, cumulative waits) a chunk of hops at a time, forever"""
+        generator = np.random.Generator(np.random.PCG64(walk.seed))
+        chunk = 2 * max(32, (walk.radius * walk.radius + 1) // 2) # even so every chunk starts on the same sublattice
+        signs = np.resize([-1, 1] if walk.odd else [1, -1], chunk)[:, None]
+        offset = np.zeros(3, dtype=np.int64)
+        elapsed = 0.0
+        while True:
+            path = offset + np.cumsum(self.moves[generator.integers(0, 4, chunk)] * signs, axis=0)
+            times = elapsed + np.cumsum(generator.standard_exponential(chunk))
+            yield path, times
+            offset, elapsed = path[-1], times[-1]
+
+    def radius(self, lattice, slot, pos):
+        # every site the walk can reach (inside radius, plus the hop out) has to stay further than
+        # capture_radius from every other defect and from anywhere another walk could reach
+        # most vacancies that can't go have something close by, find that out with a small search first
+        if lattice.cells.nearest(pos, self.min_radius + 2 + self.capture_radius, exclude=slot):
+            return 0
+        reach = self.max_radius + 2 + self.capture_radius
+        limit = math.inf
+        nearest = lattice.cells.nearest(pos, reach, exclude=slot)
+        if nearest:
+            limit = nearest[1]
+        for other, d in self.domains.within(pos, reach + self.max_radius + 2):
+            limit = min(limit, d - self.walks[other].radius - 2)
+        if limit == math.inf:
+            return self.max_radius
+        return min(self.max_radius, math.ceil(limit - self.capture_radius - 2) - 1)
+
+    def protect(self, lattice, slot, time):
+        """Sends the vacancy in slot off on a first passage walk if it's far enough from everything,
+        returns whether it went"""
+        pos = tuple(lattice.store.pos[slot].tolist())
+        radius = self.radius(lattice, slot, pos)
+        if radius < self.min_radius:
+            return False
+        walk = Walk()
+        walk.t0 = time
+        walk.seed = lattice.rng.integer(1 << 53)
+        walk.radius = radius
+        walk.odd = pos[0] % 2 != 0
+        walk.rate = float(lattice.store.rate[slot])
+        hops = 0
+        for path, times in self.chunks(walk):
+            out = np.flatnonzero((path * path).sum(axis=1) >= radius * radius)
+            if len(out):
+                i = int(out[0])
+                walk.hops = hops + i + 1
+                walk.exit = tuple(path[i].tolist())
+                walk.t_exit = float(time + times[i] / walk.rate)
+                break
+            hops += len(path)
+        lattice.clear_site(pos)
+        lattice.rates.set(slot, 0)
+        self.start(slot, walk, pos)
+        return True
+
+    def start(self, slot, walk, pos):
+        self.walks[slot] = walk
+        self.domains.insert(pos, slot)
+        heapq.heappush(self.events, (walk.t_exit, slot))
+
+    def next_landing(self):
+        """Time of the next walk to land, inf if there aren't any"""
+        events = self.events
+        while events:
+            t, slot = events[0]
+            walk = self.walks.get(slot)
+            if walk is not None and walk.t_exit == t:
+                return t
+            heapq.heappop(events) # cut short since
+        return math.inf
+
+    def land(self, lattice):
+        """Puts the next walk to land on its landing site, returns its slot"""
+        t, slot = heapq.heappop(self.events)
+        walk = self.walks[slot]
+        self.finish(lattice, slot, walk.exit)
+        self.hops += walk.hops
+        return slot
+
+    def disrupt(self, lattice, pos, time):
+        """Cuts short every walk that could come within capture_radius of pos (or land on it)"""
+        for slot, d in self.domains.within(pos, self.max_radius + 2 + self.capture_radius):
+            if d <= self.walks[slot].radius + 2 + self.capture_radius:
+                self.cut(lattice, slot, time)
+
+    def disrupt_all(self, lattice, time):
+        """Cuts short every walk, e.g. when the rate they were drawn with is about to change"""
+        for slot in list(self.walks):
+            self.cut(lattice, slot, time)
+
+    def cut(self, lattice, slot, time):
+        offset, hops = self.replay(self.walks[slot], time)
+        self.finish(lattice, slot, offset)
+        self.hops += hops
+
+    def replay(self, walk, time):
+        # same seed same path, count the hops that have happened by time
+        offset, hops = (0, 0, 0), 0
+        for path, times in self.chunks(walk):
+            done = int(np.count_nonzero(walk.t0 + times / walk.rate <= time))
+            if done:
+                offset = tuple(path[done - 1].tolist())
+            hops += done
+            if done < len(path):
+                return offset, hops
+
+    def position(self, lattice, slot, time):
+        """Where the vacancy in slot has got to at time"""
+        offset, hops = self.replay(self.walks[slot], time)
+        start = lattice.store.pos[slot]
+        return lattice.wrap([int(start[i]) + offset[i] for i in range(3)])
+
+    def finish(self, lattice, slot, offset):
+        # back onto the lattice as a normal vacancy
+        walk = self.walks.pop(slot)
+        start = tuple(lattice.store.pos[slot].tolist())
+        self.domains.remove(start)
+        pos = lattice.wrap([start[i] + offset[i] for i in range(3)])
+        lattice.store.pos[slot] = pos
+        lattice.set_site(pos, slot)
+        lattice.rates.set(slot, walk.rate)
+
+    def get_state(self):
+        return {"max_radius": self.max_radius, "min_radius": self.min_radius, "hops": self.hops,
+                "walks": [[slot, walk.t0, walk.seed, walk.radius, walk.hops, list(walk.exit), walk.t_exit]
+                          for slot, walk in self.walks.items()]}
+
+    @classmethod
+    def from_state(cls, state, lattice, moves):
+        """Puts the walks back on lattice, which has to have everything else loaded already"""
+        first_passage = cls(lattice.box, lattice.reactions.furthest, moves, state["max_radius"], state["min_radius"])
+        first_passage.hops = state["hops"]
+        for slot, t0, seed, radius, hops, exit, t_exit in state["walks"]:
+            pos = tuple(lattice.store.pos[slot].tolist())
+            walk = Walk()
+            walk.t0, walk.seed, walk.radius, walk.hops, walk.exit, walk.t_exit = t0, seed, radius, hops, tuple(exit), t_exit
+            walk.odd = pos[0] % 2 != 0
+            walk.rate = float(lattice.store.rate[slot])
+            lattice.rates.set(slot, 0)
+            first_passage.start(slot, walk, pos)
+        return first_passage
@@ -101,23 +101,24 @@ def combine(array, i, j):
     del(array[n])
     del(array[m])
 
-defects = []
-for _ in range(num_vacancies):
-    defects.append(defect('vacancy'))
-for _ in range(num_interstitials):
-    defects.append(defect('interstitial'))
+if __name__ == "__main__":
+    defects = []
+    for _ in range(num_vacancies):
+        defects.append(defect('vacancy'))
+    for _ in range(num_interstitials):
+        defects.append(defect('interstitial'))
 
-# array of pointers to coordinates
+    # array of pointers to coordinates
 
-coords = [defect.coords for defect in defects]
-i = 0
-while len(defects) > 0 and i < 1000000:
-    i += 1
-    index = random.randint(0, len(defects)-1)
-    defect = defects[index]
-    defect.hop()
-    neigh = defect.neighbour_index(coords)  
-    if neigh != None:
-        combine(defects, index, neigh) 
-        coords = [defect.coords for defect in defects]
-        print(i, neigh, len(coords))
+    coords = [defect.coords for defect in defects]
+    i = 0
+    while len(defects) > 0 and i < 1000000:
+        i += 1
+        index = random.randint(0, len(defects)-1)
+        defect = defects[index]
+        defect.hop()
+        neigh = defect.neighbour_index(coords)  
+        if neigh != None:
+            combine(defects, index, neigh) 
+            coords = [defect.coords for defect in defects]
+            print(i, neigh, len(coords))
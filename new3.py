@@ -1,8 +1,23 @@
 import random
+import os
+import sys
+import json
+import math
+import time as clock
 import numpy as np
 from ase import Atoms
 from ase.io import write
-import os
+from sumtree import RateTree, RateClasses
+from celllist import CellList
+from defectstore import DefectStore
+from trajectory import ExtxyzWriter, BinaryTrajectoryWriter
+from rng import RandomStream
+from firstpassage import FirstPassage
+from schedule import Schedule
+from reactions import Reactions, default_catalog, MERGE, BIND
+from capturezones import CaptureZones
+from blockedsites import BlockedSites
+from profiler import Profiler
 
 def add(vec1, vec2):
     return tuple([vec1[i] + vec2[i] for i in range(3)])
@@ -15,13 +30,86 @@ moves_odd = [[-1, -1, -1], [1, -1, 1], [1, 1, -1], [-1, 1, 1]]
 
 kB = 8.617333262e-5
 
+stencils = {} # (radius, odd) -> [(distance, [offsets]), ...]
+
+def get_stencil(radius, odd):
+    """Every offset in the (2r+1)^3 cube that lands on another diamond site, in shells of equal
+    distance nearest first. Cached per radius and sublattice"""
+    if (radius, odd) not in stencils:
+        shells = {}
+        for dx in range(-radius, radius+1):
+            for dy in range(-radius, radius+1):
+                for dz in range(-radius, radius+1):
+                    if dx == dy == dz == 0:
+                        continue
+                    if dx % 2 == 0 and dy % 2 == 0 and dz % 2 == 0:
+                        # same sublattice, the sum has to stay a multiple of 4
+                        valid = (dx + dy + dz) % 4 == 0
+                    elif dx % 2 != 0 and dy % 2 != 0 and dz % 2 != 0:
+                        # hopping over to the other sublattice
+                        valid = (dx + dy + dz) % 4 == (1 if odd else 3)
+                    else:
+                        valid = False
+                    if valid:
+                        shells.setdefault(dx*dx + dy*dy + dz*dz, []).append((dx, dy, dz))
+        stencils[radius, odd] = [(np.sqrt(r2), shells[r2]) for r2 in sorted(shells)]
+    return stencils[radius, odd]
+
 class Defect:
-    def __init__(self, pos, lattice=None):
-        self.pos = tuple(pos) # has to be a tuple as you can't hash lists
+    """
+    A view onto one row of the lattice's DefectStore, from lattice.view(slot). Don't keep one
+    after its defect is removed, the slot gets reused
+    """
+    __slots__ = ('_pos', '_rate', 'lattice', 'slot')
+    species = None
+    symbol = None # what a single site defect is drawn as in the output, complexes override atoms() instead
+    extra_fields = () # anything else a view needs that doesn't fit in a store row
+    placement = "site" # how add_defect() puts it down, "site", "complex" (every site in sites()) or None (not finished, left alone)
+
+    def __init__(self, pos, lattice=None, rate=None): # None takes the rate for the type from the lattice's rate table when it's added
+        self.slot = None # row in the lattice's store, None until the defect is on a lattice
+        self._pos = tuple(pos) # has to be a tuple as you can't hash lists
+        self._rate = rate
         self.lattice = lattice
         if lattice != None:
             self.lattice.add_defect(self)
-        self.rate = 0 # by default any defect has a diffusion rate of 0
+
+    @property
+    def pos(self):
+        if self.slot is None:
+            return self._pos
+        return tuple(self.lattice.store.pos[self.slot].tolist())
+
+    @pos.setter
+    def pos(self, pos):
+        if self.slot is None:
+            self._pos = tuple(pos)
+        else:
+            self.lattice.store.pos[self.slot] = pos
+
+    @property
+    def rate(self):
+        if self.slot is None:
+            return self._rate
+        return self.lattice.store.rate[self.slot]
+
+    @rate.setter
+    def rate(self, rate):
+        if self.slot is None:
+            self._rate = rate
+        else:
+            self.lattice.set_rate(self, rate)
+
+    @classmethod
+    def view(cls, lattice, slot):
+        defect = cls.__new__(cls)
+        defect.lattice = lattice
+        defect.slot = slot
+        defect._pos = None
+        defect._rate = None
+        for field, value in lattice.store.extra.get(slot, {}).items():
+            setattr(defect, field, value)
+        return defect
 
     def __str__(self):
         return f"{self.__class__.__name__} {str(self.pos)}"
@@ -31,67 +119,97 @@ class Defect:
 
     def move_to(self, vec):
         old_pos = self.pos
-        del self.lattice.defects[self.pos] # remove defect from lattice
+        self.lattice.clear_site(self.pos) # remove defect from lattice
         self.pos = tuple(vec)
         if self.lattice.add_defect(self) != 0:
             self.pos = old_pos # if we don't move successfully then reinstate the old position
             self.lattice.add_defect(self)
         
     def move_by(self, vec):
-        del self.lattice.defects[self.pos] # remove defect from lattice
+        if self.lattice.packed:
+            return self.lattice.hop(self, vec)
+        self.lattice.clear_site(self.pos) # remove defect from lattice
         self.pos = add(self.pos, vec)
         if self.lattice.add_defect(self) != 0: # if we didn't move successfully then just stay put
             self.pos = minus(self.pos, vec)
             self.lattice.add_defect(self)
+            return 1
+        return 0
 
-    def get_neighbours_old(self, radius=3):
+    def probe(self, radius=3):
+        """Yields (defect, d) for every occupied diamond site in the cube around us, nearest shell first"""
+        defects = self.lattice.defects
+        for key, d in self.probe_keys(radius):
+            yield self.lattice.view(defects[key]), d
+
+    def probe_keys(self, radius=3):
+        """Same as probe but yields the (key, d) of each occupied site, without making a view"""
+        lattice = self.lattice
+        defects = lattice.defects
+        if lattice.packed:
+            # same stencil but as packed deltas, the wrapped neighbour key is just a couple of integer ops
+            key = lattice.key(self.pos)
+            key_low, key_high = key & lattice.low, key & lattice.high
+            for d, deltas in lattice.stencil_deltas(radius, self.pos[0] % 2 != 0):
+                for delta_low, delta_high in deltas:
+                    neighbour = (key_low + delta_low) ^ key_high ^ delta_high
+                    if neighbour in defects:
+                        yield neighbour, d
+            return
         x, y, z = self.pos
-        neighbours = []
-        for dx in range(-radius, radius+1):
-            for dy in range(-radius, radius+1):
-                for dz in range(-radius, radius+1):
-                    if dx == dy == dz == 0:
-                        continue
-                    neighbour_pos = (x+dx, y+dy, z+dz)
-                    if neighbour_pos in self.lattice.defects:
-                        neighbours.append(self.lattice.defects[neighbour_pos])
-        return neighbours
+        box = lattice.box
+        for d, offsets in get_stencil(radius, self.pos[0] % 2 != 0):
+            for dx, dy, dz in offsets:
+                neighbour_pos = ((x+dx) % box[0], (y+dy) % box[1], (z+dz) % box[2])
+                if neighbour_pos in defects:
+                    yield neighbour_pos, d
+
+    def get_neighbours_old(self, radius=3):
+        return [neighbour for neighbour, d in self.probe(radius)]
 
     def get_nearest_neighbour(self, radius=3):
-        x, y, z = self.pos
-        neighbours = []
-        for dx in range(-radius, radius+1):
-            for dy in range(-radius, radius+1):
-                for dz in range(-radius, radius+1):
-                    if dx == dy == dz == 0:
-                        continue
-                    neighbour_pos = (x+dx, y+dy, z+dz)
-                    if neighbour_pos in self.lattice.defects:
-                        neighbours.append([self.lattice.defects[neighbour_pos], np.linalg.norm([dx, dy, dz])])
-        if len(neighbours) > 0:
-            argmin = np.argmin(np.array(neighbours).T[1])
-            neighbours = neighbours[argmin]
-        return neighbours
+        if self.lattice.cells is not None:
+            # only looks in the cells around us, and goes round the periodic box properly
+            nearest = self.lattice.cells.nearest(self.pos, radius, exclude=self.slot)
+            if nearest:
+                nearest[0] = self.lattice.view(nearest[0])
+            return nearest
+        # shells come out nearest first, so only the first shell with a hit matters. Ties in it go to
+        # the smallest wrapped site, same as the cell list, so cell_size doesn't change the trajectory
+        lattice = self.lattice
+        best = None
+        for key, d in self.probe_keys(radius):
+            if best is not None and d > best[0]:
+                break
+            slot = lattice.defects[key]
+            if slot == self.slot: # small boxes can wrap round onto ourselves
+                continue
+            site = lattice.unkey(key)
+            if best is None or (d, site) < best[:2]:
+                best = (d, site, slot)
+        if best is None:
+            return []
+        return [lattice.view(best[2]), best[0]]
 
     def get_neighbours(self, radius=3):
-        x, y, z = self.pos
-        neighbours = []
-        for dx in range(-radius, radius+1):
-            for dy in range(-radius, radius+1):
-                for dz in range(-radius, radius+1):
-                    if dx == dy == dz == 0:
-                        continue
-                    neighbour_pos = (x+dx, y+dy, z+dz)
-                    if neighbour_pos in self.lattice.defects:
-                        neighbours.append([self.lattice.defects[neighbour_pos], np.linalg.norm([dx, dy, dz])])
-        return neighbours
+        return [[neighbour, d] for neighbour, d in self.probe(radius)]
     
     def wrap(self):
-        # this works nicely
-        pos = [0, 0, 0]
-        for i in range(3):
-            pos[i] = self.pos[i] % self.lattice.box[i] 
-        self.pos = tuple(pos)
+        self.pos = self.lattice.wrap(self.pos)
+
+    def bind(self, other, product):
+        # other has to be off the lattice already, it ends up on whichever of our neighbouring sites is closest to it
+        # measured the short way round the box, a capture can reach across the edge
+        box = np.array(self.lattice.box)
+        possible = np.array(self.pos) + self.available_moves()
+        apart = np.array(other.pos) - possible
+        apart -= box * np.round(apart / box).astype(int)
+        site = self.lattice.wrap(possible[np.argmin((apart * apart).sum(axis=1))].tolist())
+        self.lattice.remove_defect(self.pos)
+        self.lattice.add_defect(product(self.pos, tuple(site)))
+
+    def atoms(self):
+        return (self.symbol, [self.pos])
 
     def available_moves(self):
         global moves_even
@@ -103,13 +221,12 @@ class Defect:
 
 
 class Vacancy(Defect):
+    __slots__ = ()
+    species = 'C'
+    symbol = 'C'
+
     def __init__(self, pos, lattice=None):
-        self.pos = tuple(pos) # has to be a tuple as you can't hash lists
-        self.lattice = lattice
-        if lattice != None:
-            self.lattice.add_defect(self)
-        self.rate = 40e12 * np.exp(-2.3/(kB*T))
-        self.species = 'C'
+        Defect.__init__(self, pos, lattice)
 
     def vacancy_merge_old(self):
         neighbours = self.get_nearest_neighbour(radius=3) # this will only return the closest neighbour in the radius
@@ -125,85 +242,55 @@ class Vacancy(Defect):
             elif type(neighbours[0]) == Nitrogen or type(neighbours[0]) == NitrogenVacancy:
                 self.lattice.add_defect(NitrogenVacancy(pos)) 
     
-    def vacancy_merge(self):
-        neighbour = self.get_nearest_neighbour(radius=10) # returns (defect, d)
-        pos = self.pos
-        if len(neighbour) > 0: # could also do if neighbour != []
-            neighbour, d = neighbour
-            #neigh_pos = neighbour.pos
-            self.lattice.remove_defect(pos)
-            if type(neighbour) == Vacancy or type(neighbour) == VacancyCluster and d <= 3:
-                self.lattice.remove_defect(neighbour.pos)
-                self.lattice.add_defect(VacancyCluster(pos))
-            elif type(neighbour) == Nitrogen and d <= 10: 
-                #self.lattice.remove_defect(neighbour.pos)
-                #self.lattice.add_defect(NitrogenVacancy(neigh_pos))
-                neighbour.form_NV(self)
-            else:
-                self.lattice.add_defect(Vacancy(pos))
-
-    def atoms(self):
-        return ('C', [self.pos])
-            
 
 class VacancyCluster(Defect):
+    __slots__ = ()
+    species = 'O'
+    symbol = 'B'
+
     def __init__(self, pos, lattice=None): 
-        self.pos = tuple(pos)
-        self.lattice = lattice
-        if lattice != None:
-            self.lattice.add_defect(self)
-        self.rate = 0
-        self.species = 'O'
-    
-    def atoms(self):
-        return ('B', [self.pos])
+        Defect.__init__(self, pos, lattice)
             
 
 class Divacancy(Vacancy):
     # for the divacancy it will need two positions, and a vector for which 100 plane it's pointing in -> vacancy chain will have the same but many positions
+    __slots__ = ()
+    placement = None
+
     def __init__(self, pos1, pos2, vec, lattice=None): 
-        self.pos = tuple(pos)
-        self.lattice = lattice
-        if lattice != None:
-            self.lattice.add_defect(self)
-        self.rate = 0
+        Defect.__init__(self, pos1, lattice)
 
 class Nitrogen(Defect):
+    __slots__ = ()
+    species = 'N'
+    symbol = 'N'
+
     def __init__(self, pos, lattice=None): 
-        self.pos = tuple(pos)
-        self.lattice = lattice
-        if lattice != None:
-            self.lattice.add_defect(self)
-        self.rate = 0
-        self.species = 'N'
+        Defect.__init__(self, pos, lattice)
 
     def form_NV(self, V):
         # this only merges, does not distance checking or anything
-        possible_V = [add(self.pos, self.available_moves()[i]) for i in range(4)]
-        #print(np.linalg.norm(np.array(V.pos) - possible_V, axis=1) )
-        argmin = np.argmin(np.linalg.norm(np.array(V.pos) - possible_V, axis=1))
-        V_pos = tuple(possible_V[argmin])
-        #self.lattice.remove_defect(V.pos)
-        #print(V.pos)
-        self.lattice.remove_defect(self.pos)
-        self.lattice.add_defect(NitrogenVacancy(self.pos, V_pos))
-    
-    def atoms(self):
-        return ('N', [self.pos])
+        self.bind(V, NitrogenVacancy)
 
 class NitrogenVacancy(Defect):
+    # the store only has room for one site per defect, that's the N, both go in store.extra as well
+    __slots__ = ('pos_N', 'pos_V')
+    symbol = None
+    extra_fields = ('pos_N', 'pos_V')
+    species = 'B' # redundant
+    placement = "complex"
+
     def __init__(self, pos_N, pos_V, lattice=None): 
         self.pos_N = pos_N
         self.pos_V = pos_V
-        self.lattice = lattice
-        if lattice != None:
-            self.lattice.add_defect(self)
-        self.rate = 0
-        self.species = 'B' # redundant
+        Defect.__init__(self, pos_N, lattice)
 
     def atoms(self):
         return ('OC', [self.pos_N, self.pos_V])
 
+    def sites(self):
+        return (self.pos_N, self.pos_V)
+
     def __repr__(self):
         return f"{self.__class__.__name__} {"N", self.pos_N, "V", self.pos_V}"
 
@@ -211,14 +298,17 @@ class NitrogenVacancy(Defect):
 
 class NV2(Defect):
     ### BEFORE WE IMPLEMENT THIS IT'S PROBABLY WORTH IMPLEMENTING RATE BIASING VECTORS FOR NITROGEN 
+    __slots__ = ('pos_N', 'pos_V')
+    extra_fields = ('pos_N', 'pos_V')
+
     def __init__(self, pos_N, pos_V1, pos_V2, lattice=None): 
         self.pos_N = pos_N
         self.pos_V = pos_V1
-        self.lattice = lattice
-        if lattice != None:
-            self.lattice.add_defect(self)
-        self.rate = 0
-        self.dissociation = 40e12 * np.exp(-1.8/(kB*T))
+        Defect.__init__(self, pos_N, lattice)
+
+    @property
+    def dissociation(self):
+        return self.lattice.dissociation_table[self.code]
 
     def atoms(self):
         return ('OC', [self.pos_N, self.pos_V])
@@ -227,75 +317,288 @@ class NV2(Defect):
         return f"{self.__class__.__name__} {"N", self.pos_N, "V", self.pos_V1, "V", self.pos_V2}"
 
 
+# bit (x & 3) | (y & 3) << 2 | (z & 3) << 4 is set if that site is on the diamond lattice
+valid_sites = sum(1 << (x | y << 2 | z << 4) for x in range(4) for y in range(4) for z in range(4)
+                  if (x % 2 == y % 2 == z % 2 == 0 and (x + y + z) % 4 == 0) or (x % 2 == y % 2 == z % 2 == 1 and (x + y + z + 1) % 4 == 0))
+
+# one site of each of the 8 in the diamond unit cell, every site is one of these plus a multiple of 4
+basis = np.array([[0, 0, 0], [0, 2, 2], [2, 0, 2], [2, 2, 0], [1, 1, 1], [1, 3, 3], [3, 1, 3], [3, 3, 1]])
+
+# behaviour table, the index is the type code kept in DefectStore.kind (0 is an empty slot)
+defect_types = [None, Defect, Vacancy, VacancyCluster, Divacancy, Nitrogen, NitrogenVacancy, NV2]
+for code, cls in enumerate(defect_types):
+    if cls is not None:
+        cls.code = code
+# how Lattice picks the next event, see the selector argument
+selectors = {"tree": RateTree, "classes": RateClasses}
+# symbol for every single site type code, '' means ask the defect for its atoms()
+symbols = np.array([cls.symbol if cls is not None and cls.symbol is not None else '' for cls in defect_types])
+
+
 class Lattice():
     """
     Contains all the defects, moves the simulation forward
     """
-    def __init__(self, box):
+    def __init__(self, box, cell_size=8, capture_radius=10, output="output.extxyz", debug=False, seed=None, bit_generator="PCG64", selector="classes", first_passage=False, temperature=1100, catalog=None, capture_zones=True, occupancy="dict"):
+        """cell_size: width of the neighbour search cells, None probes every offset instead
+        capture_radius: how close a V has to get to an N for an NV, and for any capture the catalog leaves at None
+        catalog: every migration, capture and dissociation, see reactions.default_catalog
+        capture_zones: skip the neighbour search where nothing can be captured, needs the cell list
+        output: where write_atoms() goes, debug: check the counters against a full scan
+        seed, bit_generator ("PCG64" or "Philox"): for self.rng, which every random number comes from
+        selector: "classes" or "tree"
+        first_passage: vacancies with nothing near them jump straight out of an empty sphere, needs the cell list
+        temperature: in K, a number or a Schedule
+        occupancy: "dict" or "blocked" (power of two boxes only)"""
         assert sum(box[i] % 4 for i in range(3)) == 0, "Every lattice length must be divisible by 4"
         self.box = box # in order to make sure that any input passed is a valid shape,
         # it is probably a good idea to make box in terms of 8-atom blocks
-        self.defects = {}
+        self.occupancy = occupancy
+        # site key -> slot in the store, use view() to get a defect object back
+        self.defects = BlockedSites(box) if occupancy == "blocked" else {}
+        # power of two boxes pack (x, y, z) into a single int for the key, see key()
+        self.packed = all(box[i] & (box[i] - 1) == 0 for i in range(3))
+        if self.packed:
+            bits = [box[i].bit_length() - 1 for i in range(3)]
+            self.shifts = [0, bits[0], bits[0] + bits[1]]
+            self.masks = [box[i] - 1 for i in range(3)]
+            # top bit of every field, adding with these held back stops a carry running into the next field
+            self.high = sum(1 << (self.shifts[i] + bits[i] - 1) for i in range(3))
+            self.low = (1 << sum(bits)) - 1 - self.high
+            self.move_deltas = {tuple(move): self.key(move) for move in moves_even + moves_odd}
+            self.stencils = {}
         self.time = 0
-        try:
-            os.remove("output.extxyz") 
-        except:
-            0
+        self.steps = 0
+        # every defect on the lattice owns one slot in the store and the rate tree, NVs sit on two sites but only get one slot
+        self.store = DefectStore()
+        self.selector = selector
+        self.rates = selectors[selector]()
+        self.cell_size = cell_size
+        self.cells = CellList(box, cell_size) if cell_size is not None else None
+        self.capture_radius = capture_radius
+        self.catalog = catalog if catalog is not None else default_catalog
+        self.reactions = Reactions(self.catalog, defect_types, capture_radius)
+        self.zones = None
+        if capture_zones and self.cells is not None and self.reactions.furthest:
+            self.zones = CaptureZones(box, self.reactions.furthest, self.reactions.prefactor > 0)
+        self.output = output
+        self.writer = None # opened on the first write_atoms(), can be swapped for e.g. ExtxyzWriter(path, threaded=True)
+        self.append_output = False # set when resuming so we carry on the old trajectory
+        self.output_offset = 0 # how much of the output file belongs to this run before the writer's opened
+        # number of defects of each type code, kept up to date as defects are registered and released
+        self.counts = [0] * len(defect_types)
+        self.history = [] # (steps, time, counts) every time record_populations() is called
+        self.debug = debug
+        self.rng = RandomStream(seed, bit_generator)
+        self.profiler = None # times the phases of step() and run() when set, see Profiler
+        self.first_passage = None
+        if first_passage:
+            assert cell_size is not None, "First passage moves need the cell list"
+            self.first_passage = FirstPassage(box, self.reactions.furthest, moves_even)
+        self.schedule = temperature if isinstance(temperature, Schedule) else Schedule(temperature)
+        self.temperature = None # what rate_table was worked out at
+        self.rate_table = np.zeros(len(defect_types))
+        self.dissociation_table = np.zeros(len(defect_types)) # nothing fires these yet
+        self.update_temperature()
 
     def __str__(self):
-        return f"Lattice Defects {self.defects}"
+        return f"Lattice Defects { {self.unkey(key): self.view(slot) for key, slot in self.defects.items()} }"
+
+    def key(self, pos):
+        """Dict key for a site. Packed boxes get x | y << bx | z << (bx + by) with every coordinate
+        masked, which wraps it into the box for free (negatives included). Anything else gets the wrapped tuple"""
+        if self.packed:
+            return (pos[0] & self.masks[0]) | ((pos[1] & self.masks[1]) << self.shifts[1]) | ((pos[2] & self.masks[2]) << self.shifts[2])
+        return self.wrap(pos)
+
+    def keys(self, sites):
+        # key() for an (n, 3) array of wrapped sites
+        if self.packed:
+            return self.codes(sites).tolist()
+        return [tuple(site) for site in sites.tolist()]
+
+    def codes(self, sites):
+        # one int64 per wrapped site, the same as key() for packed boxes
+        if self.packed:
+            return sites[:, 0] | sites[:, 1] << self.shifts[1] | sites[:, 2] << self.shifts[2]
+        return (sites[:, 0] * self.box[1] + sites[:, 1]) * self.box[2] + sites[:, 2]
+
+    def unkey(self, key):
+        if self.packed:
+            return (key & self.masks[0], (key >> self.shifts[1]) & self.masks[1], (key >> self.shifts[2]) & self.masks[2])
+        return key
+
+    def wrap(self, pos):
+        if self.packed:
+            return (pos[0] & self.masks[0], pos[1] & self.masks[1], pos[2] & self.masks[2])
+        return (pos[0] % self.box[0], pos[1] % self.box[1], pos[2] % self.box[2])
+
+    def shift(self, key, delta):
+        # adds two packed keys field by field, each field wraps round on its own
+        return ((key & self.low) + (delta & self.low)) ^ ((key ^ delta) & self.high)
+
+    def valid(self, pos):
+        # checks if the position is *valid* i.e. could exist in an infinite diamond lattice,
+        # only depends on each coordinate mod 4 so packed boxes look the low two bits up in a bitmask
+        if self.packed:
+            return (valid_sites >> ((pos[0] & 3) | (pos[1] & 3) << 2 | (pos[2] & 3) << 4)) & 1 == 1
+        if pos[0] % 2 == 0 and pos[1] % 2 == 0 and pos[2] % 2 == 0 and sum(pos) % 4 == 0:
+            return True
+        return pos[0] % 2 != 0 and pos[1] % 2 != 0 and pos[2] % 2 != 0 and (sum(pos) + 1) % 4 == 0
+
+    def stencil_deltas(self, radius, odd):
+        # get_stencil with every offset as a packed delta, split into the low and high parts shift() uses
+        if (radius, odd) not in self.stencils:
+            self.stencils[radius, odd] = [(d, [(self.key(offset) & self.low, self.key(offset) & self.high) for offset in offsets])
+                                          for d, offsets in get_stencil(radius, odd)]
+        return self.stencils[radius, odd]
+
+    def hop(self, defect, vec):
+        """move_by for packed boxes, returns 0 if the defect moved and 1 if the site was taken"""
+        old = self.key(defect.pos)
+        delta = self.move_deltas.get(tuple(vec))
+        new = self.shift(old, delta if delta is not None else self.key(vec))
+        if new in self.defects:
+            print(f"A defect already exists on site {self.view(self.defects[new])}")
+            return 1
+        slot = self.defects.pop(old)
+        self.defects[new] = slot
+        pos = self.unkey(new)
+        if self.cells is not None:
+            self.cells.remove(defect.pos)
+            self.cells.insert(pos, slot)
+        if self.zones is not None:
+            kind = self.store.kind[slot]
+            self.zones.remove(defect.pos, kind, self.cells, self.store)
+            self.zones.add(pos, kind)
+        defect.pos = pos
+        return 0
+
+    def view(self, slot):
+        return defect_types[self.store.kind[slot]].view(self, slot)
 
     def add_defect(self, defect):
         # currently this both initialises defects *and* is responsible for adding them after moving, should maybe turn into two separate functions
 
-        if type(defect) == NitrogenVacancy:
+        if defect.placement == "complex":
 
             #TODO: 
             # make sure that the N and V are actually neighbouring each other
 
             # I think the idea is that we already know that both the nitrogen and the vacancy are valid, otherwise they wouldn't be able to be on the lattice
             # therefore there's probably no point in checking again :)
-            self.defects[defect.pos_N] = defect
-            self.defects[defect.pos_N].lattice = self
-            self.defects[defect.pos_V] = defect
-            self.defects[defect.pos_V].lattice = self
-
-        if type(defect) != Divacancy and type(defect) != NitrogenVacancy:
-            try:
-                print(f"A defect already exists on site {self.defects[defect.pos]}")
-            except:
-                # this allows us to add defects via lattice.add_defect directly, could be removed?
-                if defect.lattice == None:
-                    self.defects[defect.pos] = defect
-                    self.defects[defect.pos].lattice = self
-
-                # wrap first then check if we're cute and valid    
-                defect.wrap()
-                # checks if the position is *valid* i.e. could exist in an infinite diamond lattice
-                if defect.pos[0] % 2 == 0 and defect.pos[1] % 2 == 0 and defect.pos[2] % 2 == 0 and sum(defect.pos) % 4 == 0:
-                    self.defects[defect.pos] = defect
-                    self.defects[defect.pos].lattice = self
-                    return 0 
-                elif defect.pos[0] % 2 != 0 and defect.pos[1] % 2 != 0 and defect.pos[2] % 2 != 0 and (sum(defect.pos) + 1) % 4 == 0:
-                    self.defects[defect.pos] = defect
-                    self.defects[defect.pos].lattice = self
-                    return 0 
-                else: 
-                    del self.defects[defect.pos].lattice
-                    print(f"Not a valid position: {defect.pos}")
-                    return 1
+            defect.lattice = self
+            self.register(defect)
+            for site in defect.sites():
+                # anything already sitting there gets swallowed, make sure it doesn't keep its slot
+                if self.key(site) in self.defects and self.defects[self.key(site)] != defect.slot:
+                    self.remove_defect(site)
+                self.set_site(site, defect.slot)
+
+        if defect.placement == "site":
+            # this allows us to add defects via lattice.add_defect directly
+            defect.lattice = self
+            # wrap first then check if we're cute and valid, otherwise defects moving over the boundary never collide
+            defect.wrap()
+            key = self.key(defect.pos)
+            if key in self.defects:
+                print(f"A defect already exists on site {self.view(self.defects[key])}")
+                return 1
+            if self.valid(defect.pos):
+                self.register(defect)
+                self.set_site(defect.pos, defect.slot)
+                return 0 
+            else: 
+                print(f"Not a valid position: {defect.pos}")
+                return 1
+
+    def set_site(self, pos, slot):
+        # every write to the defect dict goes through here so the cell list stays in step
+        self.defects[self.key(pos)] = slot
+        if self.cells is not None:
+            self.cells.insert(pos, slot)
+        if self.zones is not None:
+            self.zones.add(pos, self.store.kind[slot])
 
+    def clear_site(self, pos):
+        slot = self.defects.pop(self.key(pos))
+        if self.cells is not None:
+            self.cells.remove(pos)
+        if self.zones is not None:
+            self.zones.remove(pos, self.store.kind[slot], self.cells, self.store)
+
+    def register(self, defect):
+        # moving a defect takes it off and back on to the dict, it keeps its slot the whole time
+        if defect.slot is not None:
+            return
+        extra = {field: getattr(defect, field) for field in defect.extra_fields}
+        rate = float(self.rate_table[defect.code]) if defect._rate is None else defect._rate
+        defect.slot = self.store.alloc(defect._pos, defect.code, rate, extra)
+        defect._pos = None
+        self.rates.set(defect.slot, rate)
+        self.counts[defect.code] += 1
+
+    def release(self, defect):
+        # hand the state back to the object, things like form_NV still look at a defect after it's gone
+        if defect.slot is None:
+            return
+        slot = defect.slot
+        defect._pos = defect.pos
+        defect._rate = defect.rate
+        defect.slot = None
+        self.rates.set(slot, 0)
+        self.store.free(slot)
+        self.counts[defect.code] -= 1
+
+    def set_rate(self, defect, rate):
+        self.store.rate[defect.slot] = rate
+        self.rates.set(defect.slot, rate)
+
+    def update_temperature(self, refresh=True):
+        """Moves the rate table on to the schedule interval self.time is in and puts every defect
+        whose type changed rate on the new one. refresh=False only swaps the table"""
+        self.next_change, temperature, self.ramping = self.schedule.interval(self.time)
+        if temperature == self.temperature:
+            return
+        if refresh and self.first_passage is not None:
+            # walks were drawn at the old rate
+            self.first_passage.disrupt_all(self, self.time)
+        old = self.rate_table
+        self.temperature = temperature
+        reactions = self.reactions
+        self.rate_table = reactions.prefactor * np.exp(-reactions.barrier / (kB * temperature))
+        self.dissociation_table = reactions.dissociation_prefactor * np.exp(-reactions.dissociation_barrier / (kB * temperature))
+        if refresh:
+            slots = self.store.live()
+            slots = slots[np.isin(self.store.kind[slots], np.flatnonzero(self.rate_table != old))]
+            self.store.rate[slots] = self.rate_table[self.store.kind[slots]]
+            self.rates.set_many(slots, self.store.rate[slots])
+
+    def acceptance(self, slot):
+        # through a ramp the table has the rates at the hot end, an event is kept with probability
+        # (rate now) / (rate in the table) so events still come at exactly the rate at T(t)
+        T = self.schedule.at(self.time)
+        return math.exp(-self.reactions.barrier[self.store.kind[slot]] / kB * (1 / T - 1 / self.temperature))
 
     def remove_defect(self, pos):
-        try:
-            del self.defects[tuple(pos)]
-        except:
+        pos = tuple(pos)
+        if self.key(pos) not in self.defects:
             print(f"No defect exists at site {pos}")
+            return
+        defect = self.view(self.defects[self.key(pos)])
+        self.clear_site(pos)
+        if defect.placement == "complex":
+            # take the whole complex off, not just one of its sites
+            for site in defect.sites():
+                if self.defects.get(self.key(site)) == defect.slot:
+                    self.clear_site(site)
+        self.release(defect)
+        return defect
 
     def write_atoms_old(self):
         spec = ''
         pos = []
-        for defect in list(self.defects.values()):
+        for defect in map(self.view, self.defects.values()):
             spec += defect.species
             pos.append(defect.pos)
         atoms = Atoms(spec, pos, cell=self.box)
@@ -304,27 +607,301 @@ class Lattice():
         write('output.extxyz', atoms, append=True)
 
     def write_atoms(self):
-        spec = ''
-        pos = []
-        for defect in list(self.defects.values()):
-            atoms = defect.atoms()
-            spec += atoms[0]
-            pos.extend(atoms[1])
+        # keeps the one file handle open for the whole run rather than going through ase every frame
+        if self.writer is None:
+            self.writer = ExtxyzWriter(self.output, append=self.append_output)
+        self.writer.write(self)
 
-        atoms = Atoms(spec, pos, cell=self.box)
-        write('output.extxyz', atoms, append=True)
+    def frame(self, with_ids=False):
+        """Species and positions of every atom in the output, read straight out of the store.
+        Each defect is written once, multi-site complexes are expanded with their atoms().
+        with_ids also returns a stable id for every atom, slot << 2 | which site of the defect it is"""
+        slots = self.store.live()
+        kinds = self.store.kind[slots]
+        single = symbols[kinds] != ''
+        positions = self.store.pos
+        if self.first_passage is not None and self.first_passage.walks:
+            # vacancies out on a walk are still at their starting site in the store, put them where they've got to
+            positions = positions.copy()
+            for slot in self.first_passage.walks:
+                positions[slot] = self.first_passage.position(self, slot, self.time)
+        species = [symbols[kinds[single]]]
+        pos = [positions[slots[single]]]
+        ids = [slots[single].astype(np.uint32) << 2]
+        for slot in slots[~single]:
+            spec, sites = self.view(slot).atoms()
+            species.append(np.array(list(spec)))
+            pos.append(np.array(sites, dtype=np.int32))
+            ids.append((np.uint32(slot) << 2) | np.arange(len(sites), dtype=np.uint32))
+        if with_ids:
+            return np.concatenate(ids), np.concatenate(species), np.concatenate(pos)
+        return np.concatenate(species), np.concatenate(pos)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    def step(self, until=None):
+        """One KMC step, returns the defect that moved or None if nothing can move any more.
+        If the next event would come after until, time stops at until and nothing happens (also None)"""
+        first_passage = self.first_passage
+        profiler = self.profiler
+        if profiler is not None:
+            start = clock.perf_counter()
+        while True:
+            if self.time >= self.next_change:
+                if profiler is not None:
+                    refresh = clock.perf_counter()
+                    self.update_temperature()
+                    profiler.timers["temperature"] += clock.perf_counter() - refresh
+                    profiler.counters["temperature_updates"] += 1
+                    start += clock.perf_counter() - refresh # not part of select
+                else:
+                    self.update_temperature()
+            walking = first_passage is not None and first_passage.walks
+            total = self.rates.total()
+            if total == 0 and not walking:
+                if until is not None:
+                    self.time = until
+                return None
+            # rates only change when a defect is added or removed or the temperature changes, so picking
+            # the next event never rebuilds every rate each step, see RateClasses and RateTree
+            # will have to maybe rethink this when it comes to dissociating
+            horizon = until if until is not None and until <= self.next_change else self.next_change
+            # the next hop and the next walk landing race each other, whichever comes first happens.
+            # if it's the landing the hop time is just thrown away, it'd be drawn fresh anyway
+            dt = self.rng.exponential() / total if total > 0 else math.inf
+            landing = first_passage.next_landing() if walking else math.inf
+            if min(landing, self.time + dt) > horizon:
+                # nothing happens before horizon, the waiting time has no memory so it's fine to throw away
+                self.time = horizon
+                if horizon == until:
+                    return None
+                continue
+            if landing <= self.time + dt:
+                if profiler is not None:
+                    landed = clock.perf_counter()
+                    profiler.timers["select"] += landed - start
+                self.time = landing
+                defect = self.view(first_passage.land(self))
+                # nothing can be in capture range of where it landed, so no merging to check
+                first_passage.protect(self, defect.slot, self.time)
+                self.steps += 1
+                if profiler is not None:
+                    profiler.timers["walks"] += clock.perf_counter() - landed
+                    profiler.counters["landings"] += 1
+                return defect
+            self.time += dt
+            slot = self.rates.sample(self.rng)
+            if not self.ramping or self.rng.uniform() < self.acceptance(slot):
+                break
+            if profiler is not None:
+                profiler.counters["thinned"] += 1
+        if profiler is not None:
+            return self.timed_hop(slot, start)
+        defect = self.view(slot)
+        vec = self.rng.choice(defect.available_moves())
+        if first_passage is not None:
+            # any walk we might bump into gets put back where it's got to first
+            first_passage.disrupt(self, add(defect.pos, vec), self.time)
+        defect.move_by(vec)
+        self.capture(defect)
+        # merging takes the vacancy off and can hand its slot straight to what it formed.
+        # no walks through a ramp, they'd be drawn at a rate that keeps changing under them
+        if first_passage is not None and not self.ramping and self.store.kind[defect.slot] == Vacancy.code:
+            first_passage.protect(self, defect.slot, self.time)
+        self.steps += 1
+        return defect
+
+    def timed_hop(self, slot, start):
+        # the end of step() with every phase timed into self.profiler, kept apart so the plain one stays lean
+        profiler = self.profiler
+        first_passage = self.first_passage
+        timers = profiler.timers
+        now = clock.perf_counter()
+        timers["select"] += now - start
+        defect = self.view(slot)
+        vec = self.rng.choice(defect.available_moves())
+        if first_passage is not None:
+            first_passage.disrupt(self, add(defect.pos, vec), self.time)
+            then = clock.perf_counter()
+            timers["walks"] += then - now
+            now = then
+        if defect.move_by(vec):
+            profiler.counters["rejected"] += 1 # the site it was going to is taken
+        then = clock.perf_counter()
+        timers["move"] += then - now
+        self.capture(defect)
+        now = clock.perf_counter()
+        timers["capture"] += now - then
+        if first_passage is not None and not self.ramping and self.store.kind[defect.slot] == Vacancy.code:
+            first_passage.protect(self, defect.slot, self.time)
+            timers["walks"] += clock.perf_counter() - now
+        profiler.counters["hops"] += 1
+        self.steps += 1
+        return defect
+
+    def capture(self, defect):
+        """Does whatever self.reactions says defect does with the nearest thing in its reach, if anything"""
+        reactions = self.reactions
+        code = defect.code
+        profiler = self.profiler
+        if not reactions.reach[code]:
+            return
+        if self.zones is not None and self.zones.clear(defect.pos):
+            if profiler is not None:
+                profiler.counters["zone_skips"] += 1
+            return
+        if profiler is not None:
+            profiler.counters["probes"] += 1
+        nearest = defect.get_nearest_neighbour(radius=reactions.reach[code]) # returns (defect, d)
+        if not nearest:
+            return
+        neighbour, d = nearest
+        if d > reactions.radius[code, neighbour.code]:
+            return
+        action = reactions.action[code, neighbour.code]
+        product = defect_types[reactions.product[code, neighbour.code]]
+        pos = defect.pos
+        if action == MERGE:
+            self.remove_defect(pos)
+            self.remove_defect(neighbour.pos)
+            self.add_defect(product(pos))
+        elif action == BIND:
+            self.remove_defect(pos)
+            neighbour.bind(defect, product)
+        if action and profiler is not None:
+            profiler.counters["captures"] += 1
+        # otherwise it just stays put, no point taking it off the lattice and putting a brand
+        # new one back in the same place (that churns a slot in the rate tree)
+
+    def run(self, num_steps, report_every=100, checkpoint=None, checkpoint_every=10000):
+        """Steps until self.steps reaches num_steps. Prints and writes a frame every report_every steps,
+        and saves a checkpoint every checkpoint_every if checkpoint is a path"""
+        profiler = self.profiler
+        while self.steps < num_steps:
+            i = self.steps
+            if self.step() is None:
+                print("Nothing left that can move")
+                break
+            if profiler is not None:
+                self.timed_housekeeping(i, num_steps, report_every, checkpoint, checkpoint_every)
+                continue
+            if i % report_every == 0:
+                print("Iteration:", f"{i}/{num_steps}", "Time:", self.time, "seconds", "V:", self.get_num_type(Vacancy), "NV:", self.get_num_type(NitrogenVacancy), "Vn:", self.get_num_type(VacancyCluster))
+                self.record_populations()
+                self.write_atoms()
+            if checkpoint is not None and self.steps % checkpoint_every == 0:
+                self.save_checkpoint(checkpoint)
+        if profiler is not None:
+            profiler.snapshot(self)
+
+    def timed_housekeeping(self, i, num_steps, report_every, checkpoint, checkpoint_every):
+        # what run() does between steps, timed into self.profiler
+        profiler = self.profiler
+        timers = profiler.timers
+        if i % report_every == 0:
+            start = clock.perf_counter()
+            print("Iteration:", f"{i}/{num_steps}", "Time:", self.time, "seconds", "V:", self.get_num_type(Vacancy), "NV:", self.get_num_type(NitrogenVacancy), "Vn:", self.get_num_type(VacancyCluster))
+            self.record_populations()
+            written = clock.perf_counter()
+            self.write_atoms()
+            timers["report"] += written - start
+            timers["output"] += clock.perf_counter() - written
+        if checkpoint is not None and self.steps % checkpoint_every == 0:
+            start = clock.perf_counter()
+            self.save_checkpoint(checkpoint)
+            timers["checkpoint"] += clock.perf_counter() - start
+        if profiler.due():
+            profiler.snapshot(self)
+
+    def save_checkpoint(self, path):
+        """Writes everything needed to carry on bit for bit, through a temporary file so a crash
+        mid-write leaves the last checkpoint alone"""
+        if self.writer is not None:
+            self.writer.flush()
+            self.output_offset = self.writer.file.tell()
+        size = self.store.size
+        keys, slots = zip(*self.defects.items()) if self.defects else ((), ())
+        sites = np.array([self.unkey(key) for key in keys], dtype=np.int32).reshape(-1, 3)
+        version, mt_state, gauss_next = random.getstate()
+        np_state = np.random.get_state()
+        meta = {
+            "box": list(self.box), "cell_size": self.cell_size, "capture_radius": self.capture_radius, "capture_zones": self.zones is not None,
+            "occupancy": self.occupancy,
+            "output": self.output, "time": self.time, "steps": self.steps,
+            # frames written after this get cut off again on resume
+            "output_path": self.writer.path if self.writer is not None else self.output, "output_offset": self.output_offset,
+            "output_format": "binary" if isinstance(self.writer, BinaryTrajectoryWriter) else "extxyz",
+            "selector": self.selector, "rates": self.rates.get_state(), "free_slots": self.store.free_slots,
+            # the extra fields of complexes, e.g. both sites of an NV
+            "extra": [[slot, extra] for slot, extra in self.store.extra.items()],
+            "random": [version, gauss_next], "np_random": [np_state[0]] + list(np_state[2:]),
+            "history": self.history, "rng": self.rng.get_state(), "schedule": self.schedule.get_state(),
+            "catalog": self.catalog,
+            "first_passage": self.first_passage.get_state() if self.first_passage is not None else None,
+        }
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            np.savez(f, meta=np.array(json.dumps(meta)), pos=self.store.pos[:size], kind=self.store.kind[:size],
+                     rate=self.store.rate[:size], sites=sites, site_slots=np.array(slots, dtype=np.int64),
+                     random=np.array(mt_state, dtype=np.uint64), np_random=np_state[1])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
 
-    def choose_defect(self):
-        # maybe make it so that we only change rates in the array induvidually instead of always
-        # recreating this array? it's currently the bottleneck imo
-        # will have to maybe rethink this when it comes to dissociating
-        rates = []
-        for defect in list(self.defects.values()):
-            rates.append(defect.rate)
-        tot_rate = sum(rates)
-        rates = np.array(rates) / tot_rate
-        self.time += 1/tot_rate * np.log(1/np.random.uniform())
-        return np.random.choice(list(self.defects.values()), 1, p=rates)[0]
+    @classmethod
+    def load_checkpoint(cls, path):
+        """Rebuilds a lattice from save_checkpoint() and puts the random number streams back where they were"""
+        data = np.load(path)
+        meta = json.loads(str(data["meta"]))
+        lattice = cls(meta["box"], cell_size=meta["cell_size"], capture_radius=meta["capture_radius"], output=meta["output"],
+                      selector=meta.get("selector", "tree"),
+                      temperature=Schedule.from_state(meta["schedule"]) if "schedule" in meta else T,
+                      catalog=meta.get("catalog"), capture_zones=meta.get("capture_zones", True),
+                      occupancy=meta.get("occupancy", "dict"))
+        lattice.time = meta["time"]
+        lattice.steps = meta["steps"]
+        lattice.append_output = True
+        # anything written after the checkpoint (or half a frame from a crash) is going to be written again
+        output = meta.get("output_path", meta["output"])
+        if "output_offset" in meta and os.path.exists(output) and os.path.getsize(output) > meta["output_offset"]:
+            os.truncate(output, meta["output_offset"])
+        lattice.output_offset = meta.get("output_offset", 0)
+        if meta.get("output_format") == "binary":
+            # carries on from the last whole frame, starting with a keyframe
+            lattice.writer = BinaryTrajectoryWriter(output, lattice.box, append=True)
+
+        store = lattice.store
+        size = len(data["kind"])
+        while len(store.kind) < size:
+            store.grow()
+        store.pos[:size] = data["pos"]
+        store.kind[:size] = data["kind"]
+        store.rate[:size] = data["rate"]
+        store.size = size
+        store.free_slots = meta["free_slots"]
+        store.extra = {slot: {field: tuple(value) if isinstance(value, list) else value for field, value in extra.items()}
+                       for slot, extra in meta["extra"]}
+
+        # same tree capacity / class member order as before so the same random numbers pick the same defects
+        rates = meta["rates"] if "rates" in meta else {"capacity": meta["rate_capacity"]} # older checkpoints
+        lattice.rates = selectors[lattice.selector].from_state(rates, store.rate[:size])
+        lattice.update_temperature(refresh=False) # the store has the rates for where the schedule is up to
+
+        for site, slot in zip(data["sites"].tolist(), data["site_slots"].tolist()):
+            lattice.set_site(tuple(site), slot)
+        lattice.counts = lattice.count_types()
+        lattice.history = [tuple(entry) for entry in meta["history"]]
+
+        version, gauss_next = meta["random"]
+        random.setstate((version, tuple(data["random"].tolist()), gauss_next))
+        np.random.set_state((meta["np_random"][0], data["np_random"], *meta["np_random"][1:]))
+        lattice.rng = RandomStream.from_state(meta["rng"])
+        if meta.get("first_passage") is not None:
+            # vacancies out on a walk aren't in sites, they go back in as walks
+            lattice.first_passage = FirstPassage.from_state(meta["first_passage"], lattice, moves_even)
+        return lattice
 
     def get_grid(self):
         """Returns a basically unordered array of every valid grid point.
@@ -345,54 +922,135 @@ class Lattice():
         return valid_combinations + odds
 
     def random_gaussian_pos(self, sigma=64):
-        # this is biased towards being placed on even cells currently
-        arr = [4 * round(np.random.normal(self.box[i]/2, sigma)/4) for i in range(3)]
-        return tuple(arr)
+        return tuple(self.draw_sites(1, "gaussian", sigma=sigma)[0].tolist())
 
     def random_uniform_pos(self):
-        # this is biased towards being placed on even cells currently
-        return tuple([4 * round(np.random.uniform(0, self.box[i])/4) for i in range(3)])
+        return tuple(self.draw_sites(1)[0].tolist())
+
+    def draw_sites(self, n, distribution="uniform", sigma=64, centre=None, profile=None, axis=2):
+        """n random diamond sites as an (n, 3) array, see populate() for the distributions.
+        Each point goes to the nearest site on either sublattice, so both get filled evenly"""
+        generator = self.rng.generator
+        box = np.array(self.box)
+        if distribution == "uniform":
+            points = generator.uniform(0, box, (n, 3))
+        elif distribution == "gaussian":
+            points = generator.normal(box / 2 if centre is None else centre, sigma, (n, 3))
+        elif distribution == "profile":
+            depths = np.arange(box[axis])
+            weights = np.asarray(profile(depths) if callable(profile) else profile, dtype=float)
+            points = generator.uniform(0, box, (n, 3))
+            points[:, axis] = generator.choice(depths, n, p=weights / weights.sum()) + generator.uniform(-0.5, 0.5, n)
+        else:
+            raise ValueError(f"Unknown distribution {distribution}")
+        sites = np.empty((n, 3), dtype=np.int64)
+        for start in range(0, n, 1 << 16):
+            chunk = points[start:start + (1 << 16), None, :]
+            candidates = basis + 4 * np.round((chunk - basis) / 4)
+            nearest = ((candidates - chunk) ** 2).sum(axis=2).argmin(axis=1)
+            sites[start:start + len(chunk)] = candidates[np.arange(len(chunk)), nearest]
+        return sites % box
+
+    def populate(self, cls, n, distribution="uniform", sigma=64, centre=None, profile=None, axis=2):
+        """Puts n single site defects of type cls down in one go and returns their slots.
+        distribution is "uniform", "gaussian" (sigma wide around centre) or "profile" (weights
+        along axis for every depth, or a function of depth). Taken sites are drawn again"""
+        assert cls.placement == "site", "populate() only does single site defects"
+        if self.packed:
+            taken = np.fromiter(self.defects.keys(), dtype=np.int64, count=len(self.defects))
+        else:
+            taken = self.codes(np.array(list(self.defects.keys()), dtype=np.int64).reshape(-1, 3))
+        # kept sorted so checking a batch against it is one searchsorted, -1 is never a site but means it's never empty
+        taken = np.sort(np.append(taken, -1))
+        batches, drawn = [np.empty((0, 3), dtype=np.int64)], 0
+        while drawn < n:
+            new = self.draw_sites(n - drawn, distribution, sigma, centre, profile, axis)
+            codes = self.codes(new)
+            # first of any repeats, in the order they were drawn
+            keep = np.sort(np.unique(codes, return_index=True)[1])
+            found = taken[np.searchsorted(taken, codes[keep]).clip(max=len(taken) - 1)] == codes[keep]
+            keep = keep[~found]
+            batches.append(new[keep])
+            taken = np.sort(np.concatenate([taken, codes[keep]]))
+            drawn += len(keep)
+        sites = np.concatenate(batches)
+        slots = self.store.alloc_many(sites, cls.code, self.rate_table[cls.code])
+        if self.rate_table[cls.code]:
+            self.rates.set_many(slots, self.store.rate[slots])
+        self.counts[cls.code] += n
+        if self.occupancy == "blocked":
+            self.defects.set_many(self.codes(sites), slots)
+        else:
+            self.defects.update(zip(self.keys(sites), slots.tolist()))
+        if self.cells is not None:
+            self.cells.insert_many(sites, slots)
+        if self.zones is not None:
+            self.zones.add_many(sites, cls.code)
+        return slots
 
     def get_num_type(self, typee):
-        num = 0
-        for defect in list(self.defects.values()):
-            if type(defect) == typee:
-                num += 1
-        return num
+        # every defect counts once, NVs included
+        if self.debug:
+            self.check_counts()
+        return self.counts[typee.code]
+
+    def count_types(self):
+        """Full scan of the store, only for checking the counters"""
+        return np.bincount(self.store.kind[self.store.live()], minlength=len(defect_types)).tolist()
+
+    def check_counts(self):
+        scanned = self.count_types()
+        assert scanned == self.counts, f"Population counters {self.counts} don't match the store {scanned}"
+
+    def record_populations(self):
+        self.history.append((self.steps, self.time, list(self.counts)))
+
+    def population_history(self):
+        """Returns (steps, times, {type name: counts}) as arrays, one entry per record_populations() call"""
+        steps = np.array([entry[0] for entry in self.history], dtype=np.int64)
+        times = np.array([entry[1] for entry in self.history])
+        counts = np.array([entry[2] for entry in self.history], dtype=np.int64).reshape(-1, len(defect_types))
+        return steps, times, {cls.__name__: counts[:, cls.code] for cls in defect_types if cls is not None}
 
 def ppm_to_num(ppm, lattice):
     return round(ppm * np.prod(lattice.box) / 80e6)
         
 ###### SIMULATION PARAMETERS
-T = 1100 # in K
+T = 1100 # in K, or a Schedule e.g. Schedule(300).ramp(1100, 1).hold(10).ramp(300, 1)
 num_steps = int(1e5)
 N_ppm = 160
 V_ppm = 40
+checkpoint_file = "checkpoint.npz" # carry on from here with python new3.py --resume
+checkpoint_every = 10000
+first_passage = True # skip isolated vacancies straight across empty lattice, see FirstPassage
+seed = None # None picks a new one every run, it's printed at the start so a run can be repeated
+profile_file = None # e.g. "profile.json" or "profile.csv", times every phase of the loop and writes them there every profile_every s
+profile_every = 60
+
+if __name__ == "__main__":
+    if "--resume" in sys.argv:
+        lattice = Lattice.load_checkpoint(checkpoint_file)
+        print(f"RESUMING FROM STEP {lattice.steps}")
+    else:
+        #64 is just over 5nm -> 7.1074 / 8 * 64 * 10e-10
+        lattice = Lattice([1024, 1024, 1024], seed=seed, first_passage=first_passage, temperature=T) # the scaling factor is 1 = 0.88425 Ansgtroms -> 4 = a
+        #lattice = Lattice([64, 64, 64]) # the scaling factor is 1 = 0.88425 Ansgtroms -> 4 = a
+        #Vacancy((20, 20, 20), lattice)
+        #lattice.add_defect(Vacancy([0, 0, 0]))
+        print("INITIALISING SYSTEM", "seed:", lattice.rng.seed)
+
+        #Vacancy([0, 0, 4], lattice)
+        #lattice.add_defect(Nitrogen([40, 40, 40]))
+        #lattice.write_atoms()
+        #lattice.defects[40, 40, 40].form_NV(lattice.defects[0, 0, 4])
+
+        lattice.populate(Vacancy, ppm_to_num(V_ppm, lattice), "gaussian")
+        lattice.populate(Nitrogen, ppm_to_num(N_ppm, lattice))
 
-#64 is just over 5nm -> 7.1074 / 8 * 64 * 10e-10
-lattice = Lattice([1024, 1024, 1024]) # the scaling factor is 1 = 0.88425 Ansgtroms -> 4 = a
-#lattice = Lattice([64, 64, 64]) # the scaling factor is 1 = 0.88425 Ansgtroms -> 4 = a
-#Vacancy((20, 20, 20), lattice)
-#lattice.add_defect(Vacancy([0, 0, 0]))
-print("INITIALISING SYSTEM")
-
-#Vacancy([0, 0, 4], lattice)
-#lattice.add_defect(Nitrogen([40, 40, 40]))
-#lattice.write_atoms()
-#lattice.defects[40, 40, 40].form_NV(lattice.defects[0, 0, 4])
-
-for i in range(ppm_to_num(V_ppm, lattice)):
-    lattice.add_defect(Vacancy(lattice.random_gaussian_pos()))
-
-for _ in range(ppm_to_num(N_ppm, lattice)):
-    lattice.add_defect(Nitrogen(lattice.random_uniform_pos()))
-
-for i in range(num_steps):
-    defect = lattice.choose_defect()
-    defect.move_by(random.choice(defect.available_moves()))
-    defect.vacancy_merge()
-    if i % 100 == 0:
-        print("Iteration:", f"{i}/{num_steps}", "Time:", lattice.time, "seconds", "V:", lattice.get_num_type(Vacancy), "NV:", lattice.get_num_type(NitrogenVacancy)/2, "Vn:", lattice.get_num_type(VacancyCluster))
-        lattice.write_atoms()
-
-print("Total simulation time:", lattice.time, "seconds")
\ No newline at end of file
+    if profile_file is not None or "--profile" in sys.argv:
+        Profiler(profile_file or "profile.json", profile_every).attach(lattice)
+    lattice.run(num_steps, checkpoint=checkpoint_file, checkpoint_every=checkpoint_every)
+    lattice.close()
+    print("Total simulation time:", lattice.time, "seconds")
+    if lattice.profiler is not None:
+        print(lattice.profiler.summary())
\ No newline at end of file
@@ -0,0 +1,341 @@
+"""
+Spatially decomposed KMC for big lattices, one process per slab of the box.
+Usage: python parallel.py [box] [sim time] [procs ...], e.g. python parallel.py 512 1 1 2 4
+runs the usual V + N anneal on each number of processes and prints the speedup and parallel
+efficiency against the first one.
+"""
+import sys
+import time as clock
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from new3 import Lattice, defect_types, NitrogenVacancy, Vacancy, VacancyCluster, ppm_to_num
+
+# what goes through the mailboxes, both for moving a defect to another process and for
+# telling a process one of its defects got swallowed by ours
+record_dtype = np.dtype([("op", "u1"), ("kind", "u1"), ("pos", "<i4", 3), ("pos_V", "<i4", 3)])
+ADD, REMOVE = 0, 1
+LEFT, RIGHT = 0, 1
+
+def to_records(lattice, slots, op=ADD):
+    slots = np.asarray(slots, dtype=np.int64)
+    records = np.zeros(len(slots), dtype=record_dtype)
+    records["op"] = op
+    records["kind"] = lattice.store.kind[slots]
+    records["pos"] = lattice.store.pos[slots]
+    for i, slot in enumerate(slots.tolist()):
+        extra = lattice.store.extra.get(slot)
+        if extra is not None and "pos_V" in extra:
+            records["pos_V"][i] = extra["pos_V"]
+    return records
+
+def from_record(record):
+    # only the types the simulation actually makes, Divacancy and NV2 aren't finished
+    cls = defect_types[record["kind"]]
+    pos = tuple(record["pos"].tolist())
+    # the rate comes from the receiving lattice's table, every process follows the same schedule
+    return cls(pos, tuple(record["pos_V"].tolist())) if cls is NitrogenVacancy else cls(pos)
+
+
+class DomainDecomposition:
+    """
+    Synchronous sublattice KMC over procs slabs along x, one forked worker each (Linux only).
+    Every window the workers run their left halves, then their right halves, swapping ghosts
+    through shared memory in between. Only exact as window goes to 0
+    """
+    def __init__(self, lattice, procs=2, window=None, mailbox_capacity=1 << 16):
+        assert lattice.first_passage is None or not lattice.first_passage.walks, "Can't split a lattice with first passage walks out"
+        self.lattice = lattice
+        self.procs = procs
+        self.halo = lattice.reactions.furthest + 4 # reach of an event past its own half, plus NV's second site
+        self.width = lattice.box[0] // procs
+        assert lattice.box[0] % procs == 0, "The box has to split evenly into slabs along x"
+        assert procs == 1 or self.width >= 4 * self.halo, f"Slabs have to be at least {4 * self.halo} wide, use fewer processes"
+        if window is None:
+            fastest = lattice.store.rate[:lattice.store.size].max(initial=0)
+            window = 1 / fastest if fastest > 0 else 1.0
+        self.window = window
+        self.mailbox_capacity = mailbox_capacity
+        self.stats = None
+
+    def run(self, until, report_every=10):
+        """Runs every worker until lattice time reaches until and returns a new Lattice with the
+        result. Prints the populations every report_every sweeps and the parallel efficiency at the end"""
+        lattice = self.lattice
+        procs = self.procs
+        records = to_records(lattice, lattice.store.live())
+        owners = records["pos"][:, 0] // self.width
+        seeds = np.random.SeedSequence(lattice.rng.integer(1 << 53)).spawn(procs)
+
+        mail = shared_memory.SharedMemory(create=True, size=2 * procs * 2 * self.mailbox_capacity * record_dtype.itemsize)
+        counters = shared_memory.SharedMemory(create=True, size=(2 * procs * 2 + procs * len(defect_types)) * 8)
+        context = mp.get_context("fork")
+        barrier = context.Barrier(procs)
+        results = context.Queue()
+        workers = [context.Process(target=work, args=(rank, self, records[owners == rank], seeds[rank], lattice.time, until,
+                                                      report_every, mail.name, counters.name, barrier, results))
+                   for rank in range(procs)]
+        start = clock.perf_counter()
+        try:
+            for worker in workers:
+                worker.start()
+            finished = {}
+            while len(finished) < procs:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise RuntimeError("A worker died, see its traceback above")
+                try:
+                    result = results.get(timeout=1)
+                except Exception:
+                    continue
+                finished[result["rank"]] = result
+            wall = clock.perf_counter() - start
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            mail.close()
+            mail.unlink()
+            counters.close()
+            counters.unlink()
+
+        merged = Lattice(lattice.box, cell_size=lattice.cell_size, capture_radius=lattice.capture_radius,
+                         output=lattice.output, selector=lattice.selector, temperature=lattice.schedule, catalog=lattice.catalog, occupancy=lattice.occupancy,
+                         first_passage=lattice.first_passage is not None, capture_zones=lattice.zones is not None,
+                         bit_generator=lattice.rng.bit_generator, debug=lattice.debug)
+        merged.rng = lattice.rng
+        for rank in range(procs):
+            for record in finished[rank]["records"]:
+                merged.add_defect(from_record(record))
+        merged.time = until
+        merged.update_temperature()
+        merged.steps = lattice.steps + sum(result["steps"] for result in finished.values())
+        merged.history = lattice.history + finished[0]["history"]
+
+        busy = np.array([finished[rank]["busy"] for rank in range(procs)])
+        waiting = np.array([finished[rank]["waiting"] for rank in range(procs)])
+        self.stats = {"procs": procs, "wall": wall, "steps": merged.steps - lattice.steps, "busy": busy.tolist(),
+                      "waiting": waiting.tolist(), "efficiency": busy.sum() / (procs * wall),
+                      "load_balance": busy.mean() / busy.max() if busy.max() > 0 else 1.0}
+        print(f"{procs} processes, {self.stats['steps']} steps in {wall:.2f} s, {self.stats['steps'] / wall:.0f} steps/s, "
+              f"busy {busy.sum() / procs / wall:.1%} of the time, load balance {self.stats['load_balance']:.1%}")
+        return merged
+
+
+class Subdomain:
+    # everything one worker process needs, lives only in that process
+    def __init__(self, rank, decomposition, records, seed, mail, counters, barrier):
+        source = decomposition.lattice
+        self.rank = rank
+        self.procs = decomposition.procs
+        self.width = decomposition.width
+        self.halo = decomposition.halo
+        self.box = source.box
+        self.lo = rank * self.width
+        self.barrier = barrier
+        self.phase = 0 # mailboxes are double buffered, flipped after every exchange
+        capacity = decomposition.mailbox_capacity
+        self.mail = np.ndarray((2, self.procs, 2, capacity), dtype=record_dtype, buffer=mail.buf)
+        self.mail_counts = np.ndarray((2, self.procs, 2), dtype=np.int64, buffer=counters.buf)
+        self.populations = np.ndarray((self.procs, len(defect_types)), dtype=np.int64, buffer=counters.buf,
+                                      offset=2 * self.procs * 2 * 8)
+        self.lattice = Lattice(source.box, cell_size=source.cell_size, capture_radius=source.capture_radius,
+                               selector=source.selector, seed=seed, temperature=source.schedule, catalog=source.catalog, occupancy=source.occupancy)
+        for record in records:
+            self.lattice.add_defect(from_record(record))
+        self.ghosts = {} # slot -> (site, kind, side it came from)
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    def local(self, x):
+        # x relative to the left edge of our slab, 0 <= u < width is ours
+        return (x - self.lo) % self.box[0]
+
+    def in_sector(self, x, sector):
+        u = self.local(x)
+        half = self.width / 2
+        return u < half if sector == 0 else half <= u < self.width
+
+    def neighbour(self, side):
+        return (self.rank - 1) % self.procs if side == LEFT else (self.rank + 1) % self.procs
+
+    def exchange(self, outgoing):
+        """outgoing is {side: records}, returns {side: records} from the neighbours on each side"""
+        buf = self.phase % 2
+        for side in (LEFT, RIGHT):
+            records = outgoing.get(side, np.zeros(0, dtype=record_dtype))
+            if len(records) > self.mail.shape[-1]:
+                raise RuntimeError(f"{len(records)} messages don't fit in the mailbox, raise mailbox_capacity")
+            self.mail[buf, self.rank, side, :len(records)] = records
+            self.mail_counts[buf, self.rank, side] = len(records)
+        start = clock.perf_counter()
+        self.barrier.wait()
+        self.waiting += clock.perf_counter() - start
+        incoming = {}
+        for side in (LEFT, RIGHT):
+            # our left neighbour wrote to its right box and the other way round
+            source = self.neighbour(side)
+            n = self.mail_counts[buf, source, 1 - side]
+            incoming[side] = self.mail[buf, source, 1 - side, :n].copy()
+        self.phase += 1
+        return incoming
+
+    def owned(self):
+        slots = self.lattice.store.live()
+        if self.ghosts:
+            slots = slots[~np.isin(slots, list(self.ghosts))]
+        return slots
+
+    def send_halo(self, sector):
+        # the neighbour whose active half sits against us needs our defects near that edge
+        lattice = self.lattice
+        slots = self.owned()
+        u = self.local(lattice.store.pos[slots, 0])
+        if sector == 0:
+            outgoing = {RIGHT: to_records(lattice, slots[u >= self.width - self.halo])}
+            side = LEFT
+        else:
+            outgoing = {LEFT: to_records(lattice, slots[u < self.halo])}
+            side = RIGHT
+        for record in self.exchange(outgoing)[side]:
+            ghost = from_record(record)
+            lattice.add_defect(ghost)
+            if ghost.slot is None:
+                continue
+            lattice.rates.set(ghost.slot, 0) # ghosts never move here, their owner moves them
+            self.ghosts[ghost.slot] = (ghost.pos, int(record["kind"]), side)
+
+    def mask(self, sector):
+        # only the active half moves, ghosts never move here, their owner moves them
+        lattice = self.lattice
+        slots = self.owned()
+        mobile = slots[lattice.store.rate[slots] > 0]
+        for slot, x in zip(mobile.tolist(), lattice.store.pos[mobile, 0].tolist()):
+            lattice.rates.set(slot, lattice.store.rate[slot] if self.in_sector(x, sector) else 0)
+        for slot in self.ghosts:
+            lattice.rates.set(slot, 0)
+
+    def window(self, sector, start, end):
+        lattice = self.lattice
+        lattice.time = start
+        lattice.update_temperature()
+        self.mask(sector)
+        while True:
+            # stop at temperature changes ourselves rather than letting step() do it, the new rates
+            # go back in over every mobile defect and the mask has to go back on top
+            defect = lattice.step(until=min(end, lattice.next_change))
+            if defect is None:
+                if lattice.time >= end:
+                    break
+                lattice.update_temperature()
+                self.mask(sector)
+                continue
+            slot = defect.slot
+            # hopped out of the active half, it waits there until its own half's turn
+            if lattice.store.kind[slot] and lattice.store.rate[slot] > 0 and not self.in_sector(lattice.store.pos[slot, 0], sector):
+                lattice.rates.set(slot, 0)
+
+    def send_changes(self):
+        """Drops the ghosts, tells their owners about the ones that got swallowed, hands over
+        anything that left our slab and takes in whatever the neighbours handed us"""
+        lattice = self.lattice
+        outgoing = {LEFT: [], RIGHT: []}
+        for slot, (site, kind, side) in self.ghosts.items():
+            if lattice.defects.get(lattice.key(site)) == slot and lattice.store.kind[slot] == kind:
+                lattice.remove_defect(site)
+            else:
+                record = np.zeros(1, dtype=record_dtype)
+                record["op"], record["kind"], record["pos"] = REMOVE, kind, site
+                outgoing[side].append(record)
+        self.ghosts = {}
+
+        slots = self.owned()
+        u = self.local(lattice.store.pos[slots, 0])
+        leaving = u >= self.width
+        # just past our right edge goes right, anything that wrapped round to just before our left edge goes left
+        right = leaving & (u < self.width + self.halo)
+        for side, chosen in ((RIGHT, slots[right]), (LEFT, slots[leaving & ~right])):
+            outgoing[side].append(to_records(lattice, chosen))
+            for pos in lattice.store.pos[chosen].tolist():
+                lattice.remove_defect(pos)
+
+        incoming = self.exchange({side: np.concatenate(records) if records else np.zeros(0, dtype=record_dtype)
+                                  for side, records in outgoing.items()})
+        for side in (LEFT, RIGHT):
+            records = incoming[side]
+            for record in records[records["op"] == REMOVE]:
+                site = tuple(record["pos"].tolist())
+                slot = lattice.defects.get(lattice.key(site))
+                if slot is not None and lattice.store.kind[slot] == record["kind"]:
+                    lattice.remove_defect(site)
+            for record in records[records["op"] == ADD]:
+                lattice.add_defect(from_record(record))
+
+    def report(self, sweep, start):
+        # everyone posts their counts, the first process adds them up and prints
+        self.populations[self.rank] = self.lattice.counts
+        self.barrier.wait()
+        if self.rank == 0:
+            counts = self.populations.sum(axis=0).tolist()
+            self.history.append((sweep, self.lattice.time, counts))
+            print("Sweep:", sweep, "Time:", self.lattice.time, "seconds", "V:", counts[Vacancy.code],
+                  "NV:", counts[NitrogenVacancy.code], "Vn:", counts[VacancyCluster.code],
+                  f"({clock.perf_counter() - start:.1f} s)")
+
+    def run(self, time, until, window, report_every):
+        self.history = []
+        start = clock.perf_counter()
+        sweep = 0
+        while time < until:
+            end = min(time + window, until)
+            for sector in (0, 1):
+                if self.procs > 1:
+                    self.send_halo(sector)
+                busy = clock.perf_counter()
+                self.window(sector, time, end)
+                self.busy += clock.perf_counter() - busy
+                if self.procs > 1:
+                    self.send_changes()
+            time = end
+            sweep += 1
+            if sweep % report_every == 0:
+                self.report(sweep, start)
+
+
+def work(rank, decomposition, records, seed, time, until, report_every, mail_name, counters_name, barrier, results):
+    mail = shared_memory.SharedMemory(name=mail_name)
+    counters = shared_memory.SharedMemory(name=counters_name)
+    try:
+        subdomain = Subdomain(rank, decomposition, records, seed, mail, counters, barrier)
+        subdomain.run(time, until, decomposition.window, report_every)
+        lattice = subdomain.lattice
+        results.put({"rank": rank, "records": to_records(lattice, lattice.store.live()), "steps": lattice.steps,
+                     "busy": subdomain.busy, "waiting": subdomain.waiting, "history": subdomain.history})
+    except BaseException:
+        barrier.abort() # everyone else would wait at the next barrier forever
+        raise
+    finally:
+        mail.close()
+        counters.close()
+
+
+if __name__ == "__main__":
+    import new3
+    box = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    until = float(sys.argv[2]) if len(sys.argv) > 2 else 1.0
+    counts = [int(n) for n in sys.argv[3:]] or [1, 2, 4]
+    serial = None
+    for procs in counts:
+        lattice = Lattice([box, box, box], seed=1234)
+        for i in range(ppm_to_num(new3.V_ppm, lattice)):
+            lattice.add_defect(Vacancy(lattice.random_gaussian_pos(sigma=box / 16)))
+        for i in range(ppm_to_num(new3.N_ppm, lattice)):
+            lattice.add_defect(new3.Nitrogen(lattice.random_uniform_pos()))
+        decomposition = DomainDecomposition(lattice, procs)
+        result = decomposition.run(until, report_every=100)
+        wall = decomposition.stats["wall"]
+        if serial is None:
+            serial = (procs, wall)
+        speedup = serial[1] / wall
+        print(f"  speedup over {serial[0]} process(es): {speedup:.2f}, parallel efficiency {speedup * serial[0] / procs:.1%}")
@@ -0,0 +1,71 @@
+import csv
+import json
+import os
+import time as clock
+
+# where the wall time in Lattice.step() and run() goes
+phases = ("select", "move", "capture", "walks", "temperature", "output", "report", "checkpoint")
+# what happened along the way
+# rejected is hops onto a taken site, thinned is events thrown away to follow a ramp
+events = ("hops", "landings", "rejected", "thinned", "captures", "probes", "zone_skips", "temperature_updates")
+
+
+class Profiler:
+    """
+    Wall time per phase of the KMC loop and counts of what happened, Profiler().attach(lattice)
+    to switch it on. With a path, run() snapshots to it (.csv or JSON) every `every` seconds
+    """
+    def __init__(self, path=None, every=60):
+        self.path = path
+        self.every = every
+        self.timers = dict.fromkeys(phases, 0.0)
+        self.counters = dict.fromkeys(events, 0)
+        self.records = []
+
+    def attach(self, lattice):
+        lattice.profiler = self
+        self.start = self.last = clock.perf_counter()
+        self.start_steps = self.last_steps = lattice.steps
+        self.start_time = self.last_time = lattice.time
+        return self
+
+    def due(self):
+        return self.path is not None and clock.perf_counter() - self.last >= self.every
+
+    def snapshot(self, lattice):
+        """Appends the totals so far to self.records and returns them, writes them all out if there's a path"""
+        now = clock.perf_counter()
+        wall, interval = now - self.start, now - self.last
+        steps, time = lattice.steps - self.start_steps, lattice.time - self.start_time
+        record = {"wall": wall, "steps": steps, "time": time,
+                  "steps_per_s": steps / wall if wall > 0 else 0.0,
+                  "sim_s_per_s": time / wall if wall > 0 else 0.0,
+                  "interval_steps_per_s": (lattice.steps - self.last_steps) / interval if interval > 0 else 0.0,
+                  "interval_sim_s_per_s": (lattice.time - self.last_time) / interval if interval > 0 else 0.0}
+        record.update({f"{phase}_s": seconds for phase, seconds in self.timers.items()})
+        record.update(self.counters)
+        self.records.append(record)
+        self.last, self.last_steps, self.last_time = now, lattice.steps, lattice.time
+        if self.path is not None:
+            self.write(self.path)
+        return record
+
+    def write(self, path):
+        # through a temporary file so whatever's watching it never sees half a file
+        temporary = path + ".tmp"
+        with open(temporary, "w", newline="") as f:
+            if path.endswith(".csv"):
+                writer = csv.DictWriter(f, fieldnames=list(self.records[0]) if self.records else [])
+                writer.writeheader()
+                writer.writerows(self.records)
+            else:
+                json.dump({"records": self.records}, f, indent=1)
+        os.replace(temporary, path)
+
+    def summary(self):
+        """One line per phase with its share of the timed total"""
+        total = sum(self.timers.values()) or 1.0
+        width = max(len(name) for name in phases + events)
+        lines = [f"{phase:>{width}}: {seconds:9.3f} s {100 * seconds / total:5.1f}%" for phase, seconds in self.timers.items()]
+        lines += [f"{name:>{width}}: {count}" for name, count in self.counters.items()]
+        return "\n".join(lines)
@@ -0,0 +1,68 @@
+import math
+import numpy as np
+
+class RateCache:
+    """
+    Arrhenius rates prefactor * exp(-E / kT) cached by E rounded to resolution (eV) and T,
+    at most max_entries of them. No rate is off by more than max_relative_error(T)
+    """
+    def __init__(self, prefactor, kb=8.617333262e-5, resolution=1e-4, max_entries=1 << 16):
+        self.prefactor = prefactor
+        self.kb = kb
+        self.resolution = resolution
+        self.max_entries = max_entries
+        self.table = {} # (level, T) -> rate
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.max_shift = 0.0
+
+    def store(self, key, rate):
+        if len(self.table) >= self.max_entries:
+            del self.table[next(iter(self.table))] # dicts keep insertion order, so this is the oldest
+            self.evictions += 1
+        self.table[key] = rate
+
+    def rate(self, energy, T):
+        level = round(float(energy) / self.resolution)
+        self.max_shift = max(self.max_shift, abs(energy - level * self.resolution))
+        rate = self.table.get((level, T))
+        if rate is not None:
+            self.hits += 1
+            return rate
+        self.misses += 1
+        # np.exp rather than math.exp so it agrees to the last bit with rates()
+        rate = float(self.prefactor * np.exp(-level * self.resolution / (self.kb * T)))
+        self.store((level, T), rate)
+        return rate
+
+    def rates(self, energies, T):
+        """rate() for an array of energies, returns an array the same shape"""
+        energies = np.asarray(energies, dtype=float)
+        if energies.size < 64:
+            # np.unique costs more than it saves on a handful
+            return np.array([self.rate(energy, T) for energy in energies.ravel().tolist()]).reshape(energies.shape)
+        levels = np.round(energies / self.resolution).astype(np.int64)
+        if levels.size:
+            self.max_shift = max(self.max_shift, float(np.abs(energies - levels * self.resolution).max()))
+        unique, inverse = np.unique(levels, return_inverse=True)
+        found = np.array([self.table.get((level, T), -1.0) for level in unique.tolist()])
+        missing = found < 0
+        if missing.any():
+            found[missing] = self.prefactor * np.exp(-unique[missing] * self.resolution / (self.kb * T))
+            for level, rate in zip(unique[missing].tolist(), found[missing].tolist()):
+                self.store((level, T), rate)
+        # a miss is one rate worked out, repeats of it in the same batch are hits
+        misses = int(missing.sum())
+        self.misses += misses
+        self.hits += levels.size - misses
+        return found[inverse].reshape(energies.shape)
+
+    def max_relative_error(self, T):
+        # the most any cached rate can be off from the exact one at T
+        return math.expm1(self.resolution / 2 / (self.kb * T))
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.table), "evictions": self.evictions, "max_shift": self.max_shift}
@@ -0,0 +1,55 @@
+import math
+import numpy as np
+
+# what happens when a mover gets within capture radius of a target
+NOTHING = 0
+MERGE = 1 # both go, the product goes on the mover's site
+BIND = 2 # the mover goes, the target turns into the product with the mover on its neighbouring site closest to where the mover was
+actions = {"merge": MERGE, "bind": BIND}
+
+# every reaction the simulation knows about, by class name so this can be written (or loaded
+# from a checkpoint) without the classes to hand. Plain lists and dicts so it goes to JSON as is
+default_catalog = {
+    # species: [prefactor in Hz, barrier in eV] for one hop
+    "migration": {"Vacancy": [40e12, 2.3]},
+    # [mover, target, capture radius, action, product], a radius of None is the lattice's capture_radius
+    "capture": [
+        ["Vacancy", "Vacancy", None, "merge", "VacancyCluster"],
+        ["Vacancy", "VacancyCluster", 3, "merge", "VacancyCluster"],
+        ["Vacancy", "Nitrogen", None, "bind", "NitrogenVacancy"],
+    ],
+    # species: [prefactor in Hz, barrier in eV, products], nothing fires these yet
+    "dissociation": {"NV2": [40e12, 1.8, ["NitrogenVacancy", "Vacancy"]]},
+}
+
+
+class Reactions:
+    """
+    A catalog compiled into tables by type code. radius/action/product are [mover, target],
+    reach is how far each mover looks. Only the nearest defect within reach can be captured
+    """
+    def __init__(self, catalog, types, capture_radius):
+        codes = {cls.__name__: code for code, cls in enumerate(types) if cls is not None}
+        n = len(types)
+        self.prefactor = np.zeros(n)
+        self.barrier = np.zeros(n)
+        for name, (prefactor, barrier) in catalog.get("migration", {}).items():
+            self.prefactor[codes[name]] = prefactor
+            self.barrier[codes[name]] = barrier
+        self.radius = np.zeros((n, n))
+        self.action = np.zeros((n, n), dtype=np.int64)
+        self.product = np.zeros((n, n), dtype=np.int64)
+        for mover, target, radius, action, product in catalog.get("capture", []):
+            pair = codes[mover], codes[target]
+            self.radius[pair] = capture_radius if radius is None else radius
+            self.action[pair] = actions[action]
+            self.product[pair] = codes[product]
+        self.reach = [math.ceil(radius) for radius in self.radius.max(axis=1).tolist()]
+        self.furthest = max(self.reach)
+        self.dissociation_prefactor = np.zeros(n)
+        self.dissociation_barrier = np.zeros(n)
+        self.dissociation_products = [()] * n
+        for name, (prefactor, barrier, products) in catalog.get("dissociation", {}).items():
+            self.dissociation_prefactor[codes[name]] = prefactor
+            self.dissociation_barrier[codes[name]] = barrier
+            self.dissociation_products[codes[name]] = tuple(codes[product] for product in products)
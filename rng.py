@@ -0,0 +1,97 @@
+import numpy as np
+
+bit_generators = {"PCG64": np.random.PCG64, "Philox": np.random.Philox}
+
+def to_json(state):
+    # bit generator states can have numpy arrays in them (Philox does), json can't
+    if isinstance(state, dict):
+        return {key: to_json(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return [to_json(value) for value in state]
+    if isinstance(state, np.ndarray):
+        return {"array": state.tolist(), "dtype": str(state.dtype)}
+    if isinstance(state, np.integer):
+        return int(state)
+    return state
+
+def from_json(state):
+    if isinstance(state, dict):
+        if set(state) == {"array", "dtype"}:
+            return np.array(state["array"], dtype=state["dtype"])
+        return {key: from_json(value) for key, value in state.items()}
+    if isinstance(state, list):
+        return [from_json(value) for value in state]
+    return state
+
+
+class RandomStream:
+    """
+    Random floats for the KMC loop, drawn a block at a time from a numpy Generator ("PCG64" or
+    "Philox"). seed=None picks one and keeps it in self.seed
+    """
+    def __init__(self, seed=None, bit_generator="PCG64", block=1 << 16):
+        sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.seed = sequence.entropy
+        self.bit_generator = bit_generator
+        self.generator = np.random.Generator(bit_generators[bit_generator](sequence))
+        self.block = block
+        # each buffer remembers the generator state it was drawn from, that's all a checkpoint needs
+        self.uniforms, self.uniform_state, self.uniform_index = [], None, 0
+        self.exponentials, self.exponential_state, self.exponential_index = [], None, 0
+
+    def fill_uniforms(self):
+        self.uniform_state = self.generator.bit_generator.state
+        self.uniforms = self.generator.random(self.block).tolist()
+        self.uniform_index = 0
+
+    def fill_exponentials(self):
+        self.exponential_state = self.generator.bit_generator.state
+        self.exponentials = self.generator.standard_exponential(self.block).tolist()
+        self.exponential_index = 0
+
+    def uniform(self):
+        """Uniform on [0, 1)"""
+        if self.uniform_index == len(self.uniforms):
+            self.fill_uniforms()
+        u = self.uniforms[self.uniform_index]
+        self.uniform_index += 1
+        return u
+
+    def exponential(self):
+        """Exponential with mean 1, the KMC time step is this over the total rate"""
+        if self.exponential_index == len(self.exponentials):
+            self.fill_exponentials()
+        e = self.exponentials[self.exponential_index]
+        self.exponential_index += 1
+        return e
+
+    def integer(self, n):
+        """Uniform integer in [0, n)"""
+        return int(self.uniform() * n)
+
+    def choice(self, seq):
+        return seq[int(self.uniform() * len(seq))]
+
+    def get_state(self):
+        """Everything needed to carry on from exactly here, json friendly"""
+        return to_json({
+            "bit_generator": self.bit_generator, "block": self.block, "seed": self.seed,
+            "state": self.generator.bit_generator.state,
+            "uniform": [self.uniform_state, self.uniform_index, len(self.uniforms)],
+            "exponential": [self.exponential_state, self.exponential_index, len(self.exponentials)],
+        })
+
+    @classmethod
+    def from_state(cls, state):
+        state = from_json(state)
+        stream = cls(state["seed"], state["bit_generator"], state["block"])
+        bit_generator = stream.generator.bit_generator
+        # redraw the current buffers from where they started, then put the generator back
+        for fill, (start, index, length), name in ((stream.fill_uniforms, state["uniform"], "uniform"),
+                                                   (stream.fill_exponentials, state["exponential"], "exponential")):
+            if length:
+                bit_generator.state = start
+                fill()
+                setattr(stream, name + "_index", index)
+        bit_generator.state = state["state"]
+        return stream
@@ -0,0 +1,66 @@
+import math
+
+class Schedule:
+    """
+    Temperature against simulated time from holds and linear ramps, stays at the last one after:
+        Schedule(300).ramp(1100, 60).hold(3600).ramp(300, 60)
+    """
+    def __init__(self, T, max_step=5):
+        self.T0 = T
+        self.max_step = max_step
+        self.segments = [] # (t_start, t_end, T_start, T_end)
+
+    def end(self):
+        return self.segments[-1][1] if self.segments else 0.0
+
+    def final(self):
+        return self.segments[-1][3] if self.segments else self.T0
+
+    def hold(self, duration):
+        T = self.final()
+        self.segments.append((self.end(), self.end() + duration, T, T))
+        return self
+
+    def ramp(self, T, duration):
+        self.segments.append((self.end(), self.end() + duration, self.final(), T))
+        return self
+
+    def segment(self, t):
+        for segment in self.segments:
+            if t < segment[1]:
+                return segment
+        return None
+
+    def at(self, t):
+        """Temperature at time t"""
+        segment = self.segment(t)
+        if segment is None:
+            return self.final()
+        t_start, t_end, T_start, T_end = segment
+        return T_start + (T_end - T_start) * (max(t, t_start) - t_start) / (t_end - t_start)
+
+    def interval(self, t):
+        """(end, T_bound, ramping) for the rate table interval containing t. T_bound is the
+        hottest temperature in it, ramping says whether events need thinning"""
+        segment = self.segment(t)
+        if segment is None:
+            return math.inf, self.final(), False
+        t_start, t_end, T_start, T_end = segment
+        if T_start == T_end:
+            return t_end, T_start, False
+        pieces = math.ceil(abs(T_end - T_start) / self.max_step)
+        width = (t_end - t_start) / pieces
+        i = min(int((t - t_start) // width), pieces - 1)
+        if i < pieces - 1 and t_start + (i + 1) * width <= t:
+            i += 1 # t is sat right on an edge that rounded down, the interval has to end after t
+        end = t_end if i == pieces - 1 else t_start + (i + 1) * width
+        return end, max(self.at(t_start + i * width), self.at(end)), True
+
+    def get_state(self):
+        return {"T0": self.T0, "max_step": self.max_step, "segments": self.segments}
+
+    @classmethod
+    def from_state(cls, state):
+        schedule = cls(state["T0"], state["max_step"])
+        schedule.segments = [tuple(segment) for segment in state["segments"]]
+        return schedule
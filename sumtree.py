@@ -0,0 +1,206 @@
+import math
+import numpy as np
+
+class RateTree:
+    """
+    Binary sum tree over defect slots, leaf i is the rate of slot i and the root the total
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.tree = np.zeros(2 * self.capacity)
+
+    def __len__(self):
+        return self.capacity
+
+    def grow(self):
+        # double the number of leaves, the old leaves keep their slot numbers
+        leaves = self.tree[self.capacity:]
+        self.capacity *= 2
+        self.tree = np.zeros(2 * self.capacity)
+        self.tree[self.capacity:self.capacity + len(leaves)] = leaves
+        self.rebuild()
+
+    def rebuild(self):
+        # recompute every internal node from the leaves, one level at a time
+        lo = self.capacity
+        while lo > 1:
+            self.tree[lo // 2:lo] = self.tree[lo:2 * lo:2] + self.tree[lo + 1:2 * lo:2]
+            lo //= 2
+
+    def set(self, slot, rate):
+        while slot >= self.capacity:
+            self.grow()
+        i = slot + self.capacity
+        tree = self.tree
+        tree[i] = rate
+        i //= 2
+        while i >= 1:
+            tree[i] = tree[2 * i] + tree[2 * i + 1]
+            i //= 2
+
+    def set_many(self, slots, rates):
+        # all the leaves at once then one pass back up, cheaper than set() once a good chunk changes
+        slots = np.asarray(slots)
+        if not len(slots):
+            return
+        while slots.max() >= self.capacity:
+            self.grow()
+        self.tree[slots + self.capacity] = rates
+        self.rebuild()
+
+    def get(self, slot):
+        return self.tree[slot + self.capacity]
+
+    def total(self):
+        return self.tree[1]
+
+    def find(self, value):
+        """Returns the slot whose cumulative rate interval contains value, 0 <= value < total"""
+        tree = self.tree
+        i = 1
+        while i < self.capacity:
+            left = tree[2 * i]
+            # never walk into an empty subtree, can happen when rounding puts value right at the total
+            if value < left or tree[2 * i + 1] == 0:
+                i = 2 * i
+            else:
+                value -= left
+                i = 2 * i + 1
+        return i - self.capacity
+
+    def sample(self, rng):
+        return self.find(rng.uniform() * self.tree[1])
+
+    def get_state(self):
+        # the leaves are the store's rates, only the shape of the tree needs keeping
+        return {"capacity": self.capacity}
+
+    @classmethod
+    def from_state(cls, state, rates):
+        tree = cls(state["capacity"])
+        tree.tree[tree.capacity:tree.capacity + len(rates)] = rates
+        tree.rebuild()
+        return tree
+
+
+class RateClasses:
+    """
+    Composition-rejection over classes of slots whose rates fall in the same power of two,
+    same set()/set_many()/get()/total()/sample() as RateTree
+    """
+    def __init__(self):
+        self.rates = {} # slot -> rate, non-zero only
+        self.classes = {} # exponent -> RateClass
+        self.total_rate = 0.0
+
+    def set(self, slot, rate):
+        old = self.rates.pop(slot, 0)
+        if old:
+            exponent = math.frexp(old)[1]
+            rate_class = self.classes[exponent]
+            rate_class.remove(slot, old)
+            if not rate_class.members:
+                del self.classes[exponent]
+        if rate:
+            self.rates[slot] = rate
+            exponent = math.frexp(rate)[1]
+            if exponent not in self.classes:
+                self.classes[exponent] = RateClass()
+            self.classes[exponent].add(slot, rate)
+        self.total_rate = sum(rate_class.total for rate_class in self.classes.values())
+
+    def set_many(self, slots, rates):
+        # slots that are already in go through set(), new ones go straight on the end of their
+        # class and the class totals are only worked out once at the end
+        touched = set()
+        for slot, rate in zip(np.asarray(slots).tolist(), np.asarray(rates).tolist()):
+            if slot in self.rates:
+                self.set(slot, rate)
+            elif rate:
+                self.rates[slot] = rate
+                exponent = math.frexp(rate)[1]
+                if exponent not in self.classes:
+                    self.classes[exponent] = RateClass()
+                rate_class = self.classes[exponent]
+                rate_class.index[slot] = len(rate_class.members)
+                rate_class.members.append(slot)
+                rate_class.counts[rate] = rate_class.counts.get(rate, 0) + 1
+                touched.add(exponent)
+        for exponent in touched:
+            self.classes[exponent].update()
+        self.total_rate = sum(rate_class.total for rate_class in self.classes.values())
+
+    def get(self, slot):
+        return self.rates.get(slot, 0)
+
+    def total(self):
+        return self.total_rate
+
+    def sample(self, rng):
+        value = rng.uniform() * self.total_rate
+        for rate_class in self.classes.values():
+            if value < rate_class.total:
+                break
+            value -= rate_class.total
+        # rounding can push value off the end, that lands in the last class
+        members = rate_class.members
+        # a rejection tries again inside the same class, going back to pick the class would skew it
+        while True:
+            slot = members[int(rng.uniform() * len(members))]
+            if len(rate_class.counts) == 1 or rng.uniform() * rate_class.ceiling < self.rates[slot]:
+                return slot
+
+    def get_state(self):
+        # member order decides which slot a given random number picks, so it's kept as is
+        return {"classes": [[exponent, rate_class.members, list(rate_class.counts.items())]
+                            for exponent, rate_class in self.classes.items()]}
+
+    @classmethod
+    def from_state(cls, state, rates):
+        classes = cls()
+        for exponent, members, counts in state["classes"]:
+            rate_class = RateClass()
+            rate_class.members = list(members)
+            rate_class.index = {slot: i for i, slot in enumerate(members)}
+            rate_class.counts = {rate: count for rate, count in counts}
+            rate_class.update()
+            classes.classes[exponent] = rate_class
+            for slot in members:
+                classes.rates[slot] = float(rates[slot])
+        classes.total_rate = sum(rate_class.total for rate_class in classes.classes.values())
+        return classes
+
+
+class RateClass:
+    # one power of two worth of rates. The total is worked out from how many members have each
+    # distinct rate rather than adding and subtracting as members come and go, so it never drifts
+    def __init__(self):
+        self.members = []
+        self.index = {} # slot -> position in members
+        self.counts = {} # rate -> number of members with it
+        self.total = 0.0
+        self.ceiling = 0.0
+
+    def add(self, slot, rate):
+        self.index[slot] = len(self.members)
+        self.members.append(slot)
+        self.counts[rate] = self.counts.get(rate, 0) + 1
+        self.update()
+
+    def remove(self, slot, rate):
+        # swap the last member into the gap
+        i = self.index.pop(slot)
+        last = self.members.pop()
+        if last != slot:
+            self.members[i] = last
+            self.index[last] = i
+        self.counts[rate] -= 1
+        if not self.counts[rate]:
+            del self.counts[rate]
+        self.update()
+
+    def update(self):
+        self.total = sum(rate * count for rate, count in self.counts.items())
+        self.ceiling = max(self.counts) if self.counts else 0.0
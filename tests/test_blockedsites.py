@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from blockedsites import BlockedSites
+
+basis = np.array([[0, 0, 0], [0, 2, 2], [2, 0, 2], [2, 2, 0], [1, 1, 1], [1, 3, 3], [3, 1, 3], [3, 3, 1]])
+box = [32, 16, 64]
+
+def key(pos):
+    return pos[0] | pos[1] << 5 | pos[2] << 9
+
+def test_against_a_dict():
+    rng = np.random.default_rng(6)
+    sites = (4 * rng.integers(0, 4, (600, 3)) + basis[rng.integers(0, 8, 600)]) % box
+    keys = [key(pos) for pos in sites.tolist()]
+    blocked, plain = BlockedSites(box, capacity=2), {}
+    for i, k in enumerate(keys):
+        if i % 4 == 3:
+            assert blocked.pop(k, None) == plain.pop(k, None)
+        else:
+            blocked[k] = plain[k] = i
+        assert len(blocked) == len(plain)
+    for k in keys:
+        assert (k in blocked) == (k in plain)
+        assert blocked.get(k, -5) == plain.get(k, -5)
+    assert sorted(blocked.items()) == sorted(plain.items())
+    assert sorted(blocked.keys()) == sorted(plain.keys())
+    missing = next(k for k in keys if k not in plain)
+    with pytest.raises(KeyError):
+        blocked.pop(missing)
+    with pytest.raises(KeyError):
+        blocked[missing]
+
+def test_set_many_matches_setitem():
+    sites = np.unique((4 * np.random.default_rng(7).integers(0, 8, (500, 3)) + basis[np.arange(500) % 8]) % box, axis=0)
+    keys = np.array([key(pos) for pos in sites.tolist()])
+    one, many = BlockedSites(box, capacity=2), BlockedSites(box, capacity=2)
+    for i, k in enumerate(keys.tolist()):
+        one[k] = i
+    many.set_many(keys[:100], np.arange(100))
+    many.set_many(keys[100:], np.arange(100, len(keys)))
+    assert len(one) == len(many)
+    assert sorted(one.items()) == sorted(many.items())
+
+def test_sites_off_the_lattice_are_never_there():
+    blocked = BlockedSites(box)
+    blocked[key((0, 0, 0))] = 7 # the block (1, 0, 0) is in has a row now
+    off = key((1, 0, 0))
+    assert off not in blocked
+    assert blocked.get(off) is None
+    assert blocked.pop(off, None) is None
+    with pytest.raises(KeyError):
+        blocked.pop(off)
+    with pytest.raises(KeyError):
+        blocked[off] = 3
+    with pytest.raises(KeyError):
+        blocked.set_many([off], [3])
+    assert len(blocked) == 1
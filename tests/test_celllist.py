@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from new3 import Lattice, Vacancy, Nitrogen
+from celllist import CellList
+
+def brute_within(entries, cells, pos, radius):
+    return sorted([item, cells.distance(pos, site)] for site, item in entries.items() if cells.distance(pos, site) <= radius)
+
+def test_queries_against_brute_force():
+    box = [40, 48, 32]
+    rng = np.random.default_rng(2)
+    sites = np.unique(rng.integers(0, 32, (400, 3)), axis=0)
+    rng.shuffle(sites)
+    one, bulk = CellList(box, 8, capacity=4), CellList(box, 8, capacity=4)
+    entries = {}
+    bulk.insert_many(sites[:200], np.arange(200))
+    for item, site in enumerate(sites[:200].tolist()):
+        one.insert(site, item)
+        entries[tuple(site)] = item
+    # then some churn, removed entries get reused
+    for item, site in enumerate(sites[200:].tolist(), start=200):
+        if item % 3 == 0:
+            gone = list(entries)[item % len(entries)]
+            del entries[gone]
+            one.remove(gone)
+            bulk.remove(gone)
+        one.insert(site, item)
+        bulk.insert(site, item)
+        entries[tuple(site)] = item
+    for pos in rng.integers(-8, 56, (40, 3)).tolist():
+        assert one.within(pos, 11) == bulk.within(pos, 11)
+        assert sorted(one.within(pos, 11)) == brute_within(entries, one, pos, 11)
+        near = brute_within(entries, one, pos, 20)
+        if near:
+            best = min(near, key=lambda entry: entry[1])
+            assert one.nearest(pos, 20)[1] == best[1]
+        else:
+            assert one.nearest(pos, 20) == []
+
+def test_insert_overwrites_and_keeps_order():
+    cells = CellList([32] * 3, 8)
+    for item, site in enumerate([(1, 1, 1), (2, 2, 0), (3, 3, 1), (33, 1, 1)]): # the last one wraps onto the first
+        cells.insert(site, item)
+    assert cells.sites_within((0, 0, 0), 5) == [((1, 1, 1), 3), ((2, 2, 0), 1), ((3, 3, 1), 2)]
+
+@pytest.mark.parametrize("box", [[48, 64, 40], [32] * 3]) # not packed and packed
+def test_probe_and_cells_pick_the_same_neighbour(tmp_path, box):
+    # ties in the first shell used to go different ways, this box split at step 59
+    def trajectory(cell_size):
+        lattice = Lattice(box, seed=5, cell_size=cell_size, output=str(tmp_path / "output.extxyz"), capture_zones=False)
+        lattice.populate(Vacancy, 150)
+        lattice.populate(Nitrogen, 150)
+        frames = []
+        for _ in range(300):
+            lattice.step()
+            frames.append(sorted((lattice.unkey(key), lattice.store.kind[slot]) for key, slot in lattice.defects.items()))
+        return frames
+    assert trajectory(8) == trajectory(None)
@@ -0,0 +1,40 @@
+import pytest
+from new3 import Lattice, Vacancy, Nitrogen
+
+def start(tmp_path, name, **options):
+    lattice = Lattice([128] * 3, seed=11, output=str(tmp_path / f"{name}.extxyz"), **options)
+    lattice.populate(Vacancy, 150)
+    lattice.populate(Nitrogen, 300)
+    return lattice
+
+def advance(lattice, steps):
+    for _ in range(steps):
+        lattice.step()
+        if lattice.steps % 10 == 0:
+            lattice.write_atoms()
+
+def state(lattice):
+    slots = lattice.store.live()
+    return (lattice.time, lattice.steps, list(lattice.counts), sorted(lattice.defects.items()),
+            lattice.store.pos[slots].tolist(), lattice.store.kind[slots].tolist(), lattice.store.rate[slots].tolist())
+
+@pytest.mark.parametrize("options", [{}, {"selector": "tree"}, {"first_passage": True}, {"occupancy": "blocked"}])
+def test_resume_is_bit_for_bit(tmp_path, options):
+    straight = start(tmp_path, "straight", **options)
+    advance(straight, 400)
+    straight.close()
+
+    interrupted = start(tmp_path, "resumed", **options)
+    advance(interrupted, 150)
+    interrupted.save_checkpoint(str(tmp_path / "checkpoint.npz"))
+    # keeps going past the checkpoint before it dies, those frames shouldn't survive the resume
+    advance(interrupted, 30)
+    interrupted.writer.flush()
+    resumed = Lattice.load_checkpoint(str(tmp_path / "checkpoint.npz"))
+    advance(resumed, 250)
+    resumed.close()
+
+    if straight.first_passage is not None:
+        assert straight.first_passage.hops # some walks actually landed
+    assert state(resumed) == state(straight)
+    assert open(tmp_path / "resumed.extxyz").read() == open(tmp_path / "straight.extxyz").read()
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from claude import DefectKMC
+
+def brute_catalog(sim):
+    # every jump's rate worked out from scratch, against every other defect rather than the neighbor list
+    catalog = []
+    for defect_id, defect in sim.defects.items():
+        energy = sim._get_base_migration_energy(defect['type'])
+        for other_id, other in sim.defects.items():
+            distance = np.linalg.norm(sim._minimum_image(other['position'] - defect['position']))
+            if other_id != defect_id and distance <= sim.cutoff:
+                energy += sim._get_interaction_energy(defect['type'], other['type'], distance)
+        rate = sim.v0 * np.exp(-energy / (sim.kb * sim.temperature))
+        catalog += [(defect_id, tuple(jump.tolist()), rate) for jump in sim._get_possible_jumps(defect_id)]
+    return sorted(catalog)
+
+def cached_catalog(sim):
+    sim._refresh_events()
+    catalog = []
+    for defect_id, slots in sim.defect_slots.items():
+        for slot in slots:
+            owner, destination = sim.events[slot]
+            assert owner == defect_id
+            catalog.append((defect_id, tuple(destination.tolist()), sim.rates.get(slot)))
+    return sorted(catalog)
+
+def compare(sim, tolerance):
+    cached, brute = cached_catalog(sim), brute_catalog(sim)
+    assert [event[:2] for event in cached] == [event[:2] for event in brute]
+    assert [event[2] for event in cached] == pytest.approx([event[2] for event in brute], rel=tolerance)
+
+@pytest.mark.parametrize("rate_resolution", [None, 1e-4])
+def test_catalog_matches_brute_force(rate_resolution):
+    np.random.seed(3)
+    sim = DefectKMC((16, 16, 16), cutoff_radius=4.0, temperature=500, rate_resolution=rate_resolution)
+    for defect_type in ['vacancy'] * 20 + ['interstitial'] * 15 + ['impurity'] * 10:
+        sim.add_defect(np.random.randint(0, 16, 3).astype(float), defect_type)
+    tolerance = 1e-9 if rate_resolution is None else sim.rate_cache.max_relative_error(sim.temperature) * 1.01
+    for _ in range(3000):
+        assert sim.run_kmc_step() is not None
+    assert sim.neighbor_rebuilds > 1 # so the incremental updates got exercised as well as full rebuilds
+    compare(sim, tolerance)
+    sim.add_defect([8.0, 8.0, 8.0], 'impurity')
+    compare(sim, tolerance)
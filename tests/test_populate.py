@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+from new3 import Lattice, Vacancy, Nitrogen
+from capturezones import CaptureZones
+
+@pytest.mark.parametrize("box, radius", [([64] * 3, 10), ([32, 64, 128], 7.5), ([16] * 3, 10)])
+def test_zone_stamping_in_bulk_matches_one_at_a_time(box, radius):
+    rng = np.random.default_rng(0)
+    corners = 4 * rng.integers(0, min(box) // 4, (400, 3))
+    basis = np.array([[0, 0, 0], [0, 2, 2], [2, 0, 2], [2, 2, 0], [1, 1, 1], [1, 3, 3], [3, 1, 3], [3, 3, 1]])
+    sites = np.unique((corners + basis[rng.integers(0, 8, 400)]) % box, axis=0)
+    bulk, single = CaptureZones(box, radius, [False]), CaptureZones(box, radius, [False])
+    bulk.add_many(sites, 0)
+    for pos in sites.tolist():
+        single.stamp(pos)
+    assert bulk.bits.any()
+    assert np.array_equal(bulk.bits, single.bits)
+
+@pytest.mark.parametrize("box, options", [([64] * 3, {}), ([48, 64, 32], {}), ([64] * 3, {"occupancy": "blocked"})])
+def test_populate_fills_distinct_free_sites(box, options):
+    lattice = Lattice(box, seed=2, **options)
+    lattice.populate(Vacancy, 300)
+    # crowded enough round the middle that lots of draws land on taken sites
+    lattice.populate(Nitrogen, 3000, distribution="gaussian", sigma=5)
+    slots = lattice.store.live()
+    sites = {tuple(pos) for pos in lattice.store.pos[slots].tolist()}
+    assert len(slots) == len(sites) == len(lattice.defects) == 3300
+    assert all(lattice.valid(site) for site in sites)
+    assert all(lattice.defects[lattice.key(lattice.store.pos[slot].tolist())] == slot for slot in slots.tolist())
+    assert lattice.counts[Vacancy.code] == 300 and lattice.counts[Nitrogen.code] == 3000
+    assert all(lattice.cells.nearest(lattice.store.pos[slot].tolist(), 0) == [slot, 0] for slot in slots.tolist())
@@ -0,0 +1,25 @@
+import pytest
+from new3 import Lattice, Vacancy, Nitrogen
+from profiler import Profiler
+from schedule import Schedule
+
+@pytest.mark.parametrize("box", [[32] * 3, [36] * 3]) # packed and not
+def test_refused_hops_are_counted(tmp_path, box):
+    # crowded enough that some hops land on a taken site
+    lattice = Lattice(box, seed=4, output=str(tmp_path / "output.extxyz"), capture_zones=False)
+    lattice.populate(Vacancy, 300)
+    lattice.populate(Nitrogen, 800)
+    profiler = Profiler().attach(lattice)
+    for _ in range(100):
+        lattice.step()
+    assert profiler.counters["hops"] == lattice.steps > 0
+    assert profiler.counters["rejected"] > 0
+    assert profiler.counters["thinned"] == 0 # nothing to thin at a constant temperature
+
+def test_ramps_thin_events(tmp_path):
+    lattice = Lattice([32] * 3, seed=4, output=str(tmp_path / "output.extxyz"), temperature=Schedule(1100).ramp(900, 0.2))
+    lattice.populate(Vacancy, 50)
+    profiler = Profiler().attach(lattice)
+    for _ in range(300):
+        lattice.step()
+    assert profiler.counters["thinned"] > 0
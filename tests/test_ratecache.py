@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+from ratecache import RateCache
+
+def exact(cache, energies, T):
+    return cache.prefactor * np.exp(-np.asarray(energies) / (cache.kb * T))
+
+@pytest.mark.parametrize("n", [10, 500]) # the loop and the np.unique path
+def test_rate_agrees_with_rates(n):
+    rng = np.random.default_rng(1)
+    energies = rng.uniform(0.2, 1.5, n)
+    energies[::3] = energies[0] # repeats get looked up rather than worked out
+    batch = RateCache(1e13).rates(energies, 700)
+    one = RateCache(1e13)
+    assert batch.tolist() == [one.rate(energy, 700) for energy in energies.tolist()]
+    # and either way round once the table's filled in
+    assert one.rates(energies, 700).tolist() == batch.tolist()
+
+@pytest.mark.parametrize("resolution", [1e-4, 1e-2])
+@pytest.mark.parametrize("T", [300, 1100])
+def test_max_relative_error_bounds_every_rate(resolution, T):
+    cache = RateCache(1e13, resolution=resolution)
+    energies = np.random.default_rng(2).uniform(0.0, 2.0, 2000)
+    error = np.abs(cache.rates(energies, T) / exact(cache, energies, T) - 1)
+    assert error.max() <= cache.max_relative_error(T) * (1 + 1e-9)
+    # and it isn't a loose bound, a shift of nearly half a step comes close to it
+    assert error.max() > 0.9 * cache.max_relative_error(T)
+    assert cache.stats()["max_shift"] <= resolution / 2 * (1 + 1e-9)
+
+def test_temperatures_are_kept_apart_and_old_entries_evicted():
+    cache = RateCache(1e13, max_entries=4)
+    assert cache.rate(0.5, 300) != cache.rate(0.5, 600)
+    for energy in [0.1, 0.2, 0.3, 0.4]:
+        cache.rate(energy, 300)
+    stats = cache.stats()
+    assert stats["entries"] == 4 and stats["evictions"] == 2
+    assert (stats["hits"], stats["misses"]) == (0, 6)
+    cache.rate(0.4, 300)
+    assert cache.stats()["hits"] == 1
@@ -0,0 +1,75 @@
+import itertools
+import numpy as np
+import pytest
+from new3 import get_stencil
+
+# the 8 diamond sites in a 4x4x4 cube, everything else on the lattice is these plus multiples of 4
+basis = {(0, 0, 0), (0, 2, 2), (2, 0, 2), (2, 2, 0), (1, 1, 1), (1, 3, 3), (3, 1, 3), (3, 3, 1)}
+
+def is_site(pos):
+    return tuple(c % 4 for c in pos) in basis
+
+def brute_stencil(radius, start):
+    shells = {}
+    for offset in itertools.product(range(-radius, radius + 1), repeat=3):
+        if any(offset) and is_site(np.add(start, offset)):
+            shells.setdefault(sum(c * c for c in offset), set()).add(offset)
+    return [(r2, shells[r2]) for r2 in sorted(shells)]
+
+@pytest.mark.parametrize("radius", [1, 2, 3, 5])
+@pytest.mark.parametrize("start", [(0, 0, 0), (2, 0, 2), (1, 1, 1), (3, 3, 1)])
+def test_stencil_against_brute_force(radius, start):
+    stencil = get_stencil(radius, start[0] % 2 != 0)
+    expected = brute_stencil(radius, start)
+    assert [set(offsets) for d, offsets in stencil] == [shell for r2, shell in expected]
+    assert [d * d for d, offsets in stencil] == pytest.approx([r2 for r2, shell in expected])
+
+def random_sites(n, box, rng):
+    corners = 4 * rng.integers(0, np.array(box) // 4, (n, 3))
+    return corners + np.array(sorted(basis))[rng.integers(0, 8, n)]
+
+def test_packed_shift_against_tuple_addition():
+    from new3 import Lattice
+    box = [32, 64, 16]
+    lattice = Lattice(box, capture_zones=False)
+    assert lattice.packed
+    rng = np.random.default_rng(3)
+    for pos, delta in zip(random_sites(500, box, rng).tolist(), rng.integers(-40, 40, (500, 3)).tolist()):
+        key = lattice.key(pos)
+        assert lattice.unkey(key) == tuple(pos)
+        expected = tuple((pos[i] + delta[i]) % box[i] for i in range(3))
+        assert lattice.unkey(lattice.shift(key, lattice.key(delta))) == expected
+
+def test_packed_stencil_against_brute_force():
+    # the packed deltas probe() adds on have to land on the same sites as the plain offsets
+    from new3 import Lattice
+    box = [16, 32, 16]
+    lattice = Lattice(box, capture_zones=False)
+    for pos in random_sites(50, box, np.random.default_rng(4)).tolist():
+        key = lattice.key(pos)
+        for radius in (1, 3):
+            odd = pos[0] % 2 != 0
+            packed = lattice.stencil_deltas(radius, odd)
+            for (d, offsets), (d_packed, deltas) in zip(get_stencil(radius, odd), packed):
+                assert d == d_packed
+                found = [(key & lattice.low) + low ^ key & lattice.high ^ high for low, high in deltas]
+                assert found == [lattice.key(np.add(pos, offset).tolist()) for offset in offsets]
+
+def test_probe_finds_the_same_neighbours_packed_or_not():
+    from new3 import Lattice, Nitrogen
+    sites = np.unique(random_sites(300, [16] * 3, np.random.default_rng(5)), axis=0).tolist()
+    found = []
+    # the same cluster in a packed box and in the middle of a bigger one that isn't
+    for box, offset in (([16] * 3, 0), ([48] * 3, 16)):
+        lattice = Lattice(box, capture_zones=False, cell_size=None)
+        for pos in sites:
+            lattice.add_defect(Nitrogen([c + offset for c in pos]))
+        probed = {}
+        for pos in sites:
+            defect = lattice.view(lattice.defects[lattice.key([c + offset for c in pos])])
+            probed[tuple(pos)] = sorted((tuple(c - offset for c in other.pos), d) for other, d in defect.probe(3))
+        found.append(probed)
+    # the small box wraps round, only compare sites whose cube stays inside it
+    inner = [pos for pos in found[0] if all(3 <= c < 13 for c in pos)]
+    assert inner
+    assert all(found[0][pos] == found[1][pos] for pos in inner)
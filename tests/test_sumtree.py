@@ -0,0 +1,78 @@
+import numpy as np
+from sumtree import RateTree, RateClasses
+
+def test_total_follows_every_change():
+    tree = RateTree(4)
+    rates = {}
+    rng = np.random.default_rng(1)
+    for slot in rng.integers(0, 40, 200).tolist(): # goes past the capacity so it has to grow
+        rates[slot] = float(rng.choice([0.0, rng.uniform(0, 5)]))
+        tree.set(slot, rates[slot])
+        assert np.isclose(tree.total(), sum(rates.values()))
+    for slot, rate in rates.items():
+        assert tree.get(slot) == rate
+
+def test_set_many_matches_set():
+    slots = np.array([3, 0, 17, 9, 40])
+    rates = np.array([1.5, 2.0, 0.25, 0.0, 3.0])
+    one, many = RateTree(8), RateTree(8)
+    for slot, rate in zip(slots.tolist(), rates.tolist()):
+        one.set(slot, rate)
+    many.set_many(slots, rates)
+    assert len(one) == len(many)
+    assert np.array_equal(one.tree, many.tree)
+
+def test_find_cumulative_intervals():
+    tree = RateTree(8)
+    tree.set_many([0, 1, 2, 5], [1.0, 0.0, 2.0, 3.0])
+    assert [tree.find(value) for value in (0.0, 0.99, 1.0, 2.99, 3.0, 5.99)] == [0, 0, 2, 2, 5, 5]
+    # right at the total (what rounding can give) still lands on a slot with a rate
+    assert tree.find(tree.total()) == 5
+
+def test_sampling_is_proportional_to_rate():
+    tree = RateTree(16)
+    rates = np.array([1.0, 0.0, 2.0, 4.0, 0.0, 1.0])
+    tree.set_many(np.arange(len(rates)), rates)
+    rng = np.random.default_rng(7)
+    n = 40000
+    counts = np.bincount([tree.sample(rng) for _ in range(n)], minlength=len(rates))
+    expected = n * rates / rates.sum()
+    assert counts[rates == 0].sum() == 0
+    # well inside 5 sigma for every slot
+    assert np.all(np.abs(counts - expected) < 5 * np.sqrt(expected + 1))
+
+def test_state_round_trip():
+    tree = RateTree(4)
+    tree.set_many([0, 6, 9], [1.0, 2.0, 3.0])
+    leaves = np.zeros(16)
+    leaves[[0, 6, 9]] = [1.0, 2.0, 3.0]
+    again = RateTree.from_state(tree.get_state(), leaves)
+    assert np.array_equal(tree.tree, again.tree)
+
+
+def test_classes_sampling_is_proportional_to_mixed_rates():
+    # several distinct rates in the same power of two, so rejections happen
+    classes = RateClasses()
+    rates = np.array([1.0, 1.5, 1.2, 3.0, 0.0, 0.3, 0.0, 1.0])
+    classes.set_many(np.arange(len(rates)), rates)
+    assert np.isclose(classes.total(), rates.sum())
+    rng = np.random.default_rng(8)
+    n = 100000
+    counts = np.bincount([classes.sample(rng) for _ in range(n)], minlength=len(rates))
+    expected = n * rates / rates.sum()
+    assert counts[rates == 0].sum() == 0
+    assert np.all(np.abs(counts - expected) < 5 * np.sqrt(expected + 1))
+
+def test_classes_follow_changes_and_state():
+    classes = RateClasses()
+    rates = {}
+    rng = np.random.default_rng(9)
+    for slot in rng.integers(0, 30, 200).tolist():
+        rates[slot] = float(rng.choice([0.0, rng.uniform(0, 5)]))
+        classes.set(slot, rates[slot])
+        assert np.isclose(classes.total(), sum(rates.values()))
+    leaves = np.zeros(30)
+    leaves[list(rates)] = list(rates.values())
+    again = RateClasses.from_state(classes.get_state(), leaves)
+    a, b = np.random.default_rng(1), np.random.default_rng(1)
+    assert [classes.sample(a) for _ in range(50)] == [again.sample(b) for _ in range(50)]
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from new3 import Lattice, Vacancy, Nitrogen
+from trajectory import ExtxyzWriter, BinaryTrajectoryWriter, TrajectoryReader
+
+def lattice(tmp_path, seed=1):
+    lattice = Lattice([32] * 3, seed=seed, output=str(tmp_path / "output.extxyz"))
+    lattice.populate(Vacancy, 40)
+    lattice.populate(Nitrogen, 80)
+    return lattice
+
+def test_extxyz_reads_back_with_ase(tmp_path):
+    ase_io = pytest.importorskip("ase.io")
+    sim = lattice(tmp_path)
+    frames = []
+    with ExtxyzWriter(str(tmp_path / "frames.extxyz")) as writer:
+        for _ in range(5):
+            sim.step()
+            frames.append(sim.frame())
+            writer.write(sim)
+    read = ase_io.read(str(tmp_path / "frames.extxyz"), index=":")
+    assert len(read) == len(frames)
+    for atoms, (species, pos) in zip(read, frames):
+        assert atoms.get_chemical_symbols() == species.tolist()
+        assert np.array_equal(atoms.positions, pos)
+        assert np.array_equal(atoms.cell.lengths(), sim.box)
+
+def test_threaded_and_appended_output_match(tmp_path):
+    paths = [str(tmp_path / name) for name in ("plain.extxyz", "threaded.extxyz", "appended.extxyz")]
+    sim = lattice(tmp_path)
+    writers = [ExtxyzWriter(paths[0]), ExtxyzWriter(paths[1], threaded=True), ExtxyzWriter(paths[2])]
+    for i in range(6):
+        sim.step()
+        if i == 3:
+            # reopened part way through, as a resumed run does
+            writers[2].close()
+            writers[2] = ExtxyzWriter(paths[2], append=True)
+        for writer in writers:
+            writer.write(sim)
+    for writer in writers:
+        writer.close()
+    text = [open(path).read() for path in paths]
+    assert text[0] == text[1] == text[2]
+
+
+def same_frame(a, b):
+    return a[0] == b[0] and np.array_equal(a[1], b[1]) and np.array_equal(a[2], b[2])
+
+def write_binary(sim, path, steps, append=False):
+    frames = []
+    with BinaryTrajectoryWriter(path, sim.box, keyframe_every=4, append=append) as writer:
+        for _ in range(steps):
+            sim.step()
+            ids, species, pos = sim.frame(with_ids=True)
+            order = np.argsort(ids)
+            frames.append((sim.time, species[order], pos[order]))
+            writer.write(sim)
+    return frames
+
+def test_reader_gives_back_every_frame(tmp_path):
+    path = str(tmp_path / "frames.kmct")
+    frames = write_binary(lattice(tmp_path), path, 11)
+    with TrajectoryReader(path) as reader:
+        assert len(reader) == len(frames)
+        assert [tag for tag, offset in reader.records] == [b"K", b"D", b"D", b"D"] * 2 + [b"K", b"D", b"D"]
+        assert all(same_frame(reader[i], frame) for i, frame in enumerate(frames))
+        assert all(same_frame(read, frame) for read, frame in zip(reader, frames))
+        assert same_frame(reader[-1], frames[-1])
+
+def test_append_carries_on_from_a_keyframe(tmp_path):
+    whole, split = str(tmp_path / "whole.kmct"), str(tmp_path / "split.kmct")
+    frames = write_binary(lattice(tmp_path), whole, 10)
+    sim = lattice(tmp_path)
+    write_binary(sim, split, 6)
+    # a crash part way through a frame leaves half a record on the end
+    with open(split, "ab") as f:
+        f.write(b"D" + bytes(10))
+    write_binary(sim, split, 4, append=True)
+    with TrajectoryReader(split) as reader:
+        assert reader.records[6][0] == b"K"
+        assert len(reader) == len(frames)
+        assert all(same_frame(read, frame) for read, frame in zip(reader, frames))
+
+def test_append_checks_the_box(tmp_path):
+    path = str(tmp_path / "frames.kmct")
+    write_binary(lattice(tmp_path), path, 2)
+    with pytest.raises(ValueError):
+        BinaryTrajectoryWriter(path, [64] * 3, append=True)
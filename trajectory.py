@@ -0,0 +1,330 @@
+import mmap
+import os
+import queue
+import threading
+import numpy as np
+
+class ExtxyzWriter:
+    """
+    Writes Lattice.frame() to an extxyz file that stays open for the whole run, threaded=True
+    formats and writes on a background thread
+    """
+    row = "%-2s %16.8f %16.8f %16.8f\n" # same layout ase uses
+
+    def __init__(self, path="output.extxyz", append=False, threaded=False, buffering=1 << 20, max_pending=16):
+        self.path = path
+        self.file = open(path, "a" if append else "w", buffering=buffering)
+        self.thread = None
+        if threaded:
+            # bounded so a slow disk pushes back on the simulation instead of eating all the memory
+            self.pending = queue.Queue(maxsize=max_pending)
+            self.thread = threading.Thread(target=self.drain, daemon=True)
+            self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, lattice):
+        species, pos = lattice.frame()
+        if self.thread is not None:
+            self.pending.put((list(lattice.box), species, pos))
+        else:
+            self.file.write(self.format(lattice.box, species, pos))
+
+    def format(self, box, species, pos):
+        n = len(species)
+        header = (f'{n}\nLattice="{float(box[0])} 0.0 0.0 0.0 {float(box[1])} 0.0 0.0 0.0 {float(box[2])}" '
+                  'Properties=species:S:1:pos:R:3 pbc="F F F"\n')
+        table = np.empty((n, 4), dtype=object)
+        table[:, 0] = species
+        table[:, 1:] = pos
+        # not vectorised, the object array just flattens the frame into one tuple for a single % over
+        # every row. Still ~2x quicker than np.savetxt, which formats a row at a time in python
+        return header + (self.row * n) % tuple(table.ravel().tolist())
+
+    def drain(self):
+        while True:
+            frame = self.pending.get()
+            if frame is not None:
+                self.file.write(self.format(*frame))
+            self.pending.task_done()
+            if frame is None:
+                break
+
+    def flush(self):
+        if self.thread is not None:
+            self.pending.join() # wait for the thread to catch up
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        if self.thread is not None:
+            self.pending.put(None)
+            self.thread.join()
+        self.file.close()
+
+
+# binary trajectory layout, everything little endian:
+#   header: MAGIC, box (3 x i4), bytes per coordinate (u1), keyframe interval (u4)
+#   then records, each starting with a one byte tag:
+#   b'S' new species symbol: code (u1), length (u1), utf-8 symbol
+#   b'K' keyframe: frame (u4), time (f8), n (u4), n atom rows
+#   b'D' delta frame: frame (u4), time (f8), n_removed, n_added, n_moved (u4 each),
+#        then the removed ids (u4), the added atom rows and the moved rows
+MAGIC = b"KMCTRJ1\0"
+header_dtype = np.dtype([("box", "<i4", 3), ("coord", "u1"), ("keyframe_every", "<u4")])
+key_dtype = np.dtype([("frame", "<u4"), ("time", "<f8"), ("n", "<u4")])
+delta_dtype = np.dtype([("frame", "<u4"), ("time", "<f8"), ("removed", "<u4"), ("added", "<u4"), ("moved", "<u4")])
+
+def atom_dtype(coord):
+    return np.dtype([("id", "<u4"), ("code", "u1"), ("pos", coord, 3)])
+
+def move_dtype(coord):
+    return np.dtype([("id", "<u4"), ("pos", coord, 3)])
+
+
+class BinaryTrajectoryWriter:
+    """
+    Binary trajectory of integer coordinates, a keyframe every keyframe_every frames and only
+    what changed in between. Drops into lattice.writer, read it back with TrajectoryReader
+    """
+    def __init__(self, path="output.kmct", box=None, keyframe_every=100, buffering=1 << 20, append=False):
+        self.path = path
+        self.keyframe_every = keyframe_every
+        self.box = None
+        self.frames = 0
+        self.codes = {} # symbol -> code
+        self.prev = None # (ids, codes, pos) of the last frame written, sorted by id
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            self.resume(box)
+            self.file = open(path, "ab", buffering=buffering)
+            return
+        self.file = open(path, "wb", buffering=buffering)
+        if box is not None:
+            self.start(box)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def start(self, box):
+        self.box = list(box)
+        self.coord = np.dtype("<i2") if max(self.box) < 2**15 - 1 else np.dtype("<i4")
+        header = np.array([(self.box, self.coord.itemsize, self.keyframe_every)], dtype=header_dtype)
+        self.file.write(MAGIC + header.tobytes())
+
+    def resume(self, box):
+        # carries on an existing file: same box, coordinates and keyframe interval, symbols keep their
+        # codes and frames their numbers. prev stays None so the first frame written is a keyframe
+        with TrajectoryReader(self.path) as reader:
+            if box is not None and list(box) != reader.box:
+                raise ValueError(f"{self.path} has box {reader.box}, not {list(box)}")
+            self.box, self.coord, self.keyframe_every = reader.box, reader.coord, reader.keyframe_every
+            self.frames = len(reader)
+            self.codes = {symbol: code for code, symbol in reader.symbols.items()}
+            end = reader.end
+        # anything after the last whole record was cut off mid write
+        os.truncate(self.path, end)
+
+    def encode(self, species):
+        # new symbols get declared in the file the first time they turn up
+        unique, inverse = np.unique(species, return_inverse=True)
+        for symbol in unique:
+            if symbol not in self.codes:
+                code = len(self.codes)
+                self.codes[symbol] = code
+                name = str(symbol).encode()
+                self.file.write(b"S" + bytes([code, len(name)]) + name)
+        lookup = np.array([self.codes[symbol] for symbol in unique], dtype=np.uint8)
+        return lookup[inverse.reshape(-1)]
+
+    def write(self, lattice):
+        if self.box is None:
+            self.start(lattice.box)
+        ids, species, pos = lattice.frame(with_ids=True)
+        order = np.argsort(ids)
+        ids, codes, pos = ids[order], self.encode(species)[order], pos[order]
+        if self.prev is None or self.frames % self.keyframe_every == 0:
+            self.write_keyframe(lattice.time, ids, codes, pos)
+        else:
+            self.write_delta(lattice.time, ids, codes, pos)
+        self.prev = (ids, codes, pos)
+        self.frames += 1
+
+    def rows(self, ids, codes, pos):
+        rows = np.empty(len(ids), dtype=atom_dtype(self.coord))
+        rows["id"] = ids
+        rows["code"] = codes
+        rows["pos"] = pos
+        return rows.tobytes()
+
+    def write_keyframe(self, time, ids, codes, pos):
+        record = np.array([(self.frames, time, len(ids))], dtype=key_dtype)
+        self.file.write(b"K" + record.tobytes() + self.rows(ids, codes, pos))
+
+    def write_delta(self, time, ids, codes, pos):
+        prev_ids, prev_codes, prev_pos = self.prev
+        # atoms in both frames, anything that changed species counts as removed and added again
+        both, cur, old = np.intersect1d(ids, prev_ids, assume_unique=True, return_indices=True)
+        same = codes[cur] == prev_codes[old]
+        kept_cur, kept_old = cur[same], old[same]
+        moved = kept_cur[np.any(pos[kept_cur] != prev_pos[kept_old], axis=1)]
+        added = np.ones(len(ids), dtype=bool)
+        added[kept_cur] = False
+        removed = np.ones(len(prev_ids), dtype=bool)
+        removed[kept_old] = False
+
+        record = np.array([(self.frames, time, removed.sum(), added.sum(), len(moved))], dtype=delta_dtype)
+        moves = np.empty(len(moved), dtype=move_dtype(self.coord))
+        moves["id"] = ids[moved]
+        moves["pos"] = pos[moved]
+        self.file.write(b"D" + record.tobytes() + prev_ids[removed].astype("<u4").tobytes()
+                        + self.rows(ids[added], codes[added], pos[added]) + moves.tobytes())
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class TrajectoryReader:
+    """
+    Memory maps a BinaryTrajectoryWriter file, reader[i] gives (time, species, pos) of frame i
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < len(MAGIC) + header_dtype.itemsize:
+                raise ValueError(f"{path} is not a binary trajectory")
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a binary trajectory")
+        offset = len(MAGIC)
+        header = np.frombuffer(self.data, dtype=header_dtype, count=1, offset=offset)[0]
+        offset += header_dtype.itemsize
+        self.box = header["box"].tolist()
+        self.keyframe_every = int(header["keyframe_every"])
+        self.coord = np.dtype("<i2") if header["coord"] == 2 else np.dtype("<i4")
+        self.atom = atom_dtype(self.coord)
+        self.move = move_dtype(self.coord)
+
+        self.symbols = {} # code -> symbol
+        self.records = [] # (tag, offset) for every frame
+        self.times = []
+        # a file still being written (or cut off by a crash) can end part way through a record,
+        # everything up to self.end is whole
+        size = len(self.data)
+        self.end = offset
+        while offset < size:
+            tag = self.data[offset:offset + 1]
+            offset += 1
+            if tag == b"S":
+                if offset + 2 > size or offset + 2 + self.data[offset + 1] > size:
+                    break
+                code, length = self.data[offset], self.data[offset + 1]
+                self.symbols[code] = self.data[offset + 2:offset + 2 + length].decode()
+                offset += 2 + length
+            elif tag == b"K":
+                if offset + key_dtype.itemsize > size:
+                    break
+                record = np.frombuffer(self.data, dtype=key_dtype, count=1, offset=offset)[0]
+                end = offset + key_dtype.itemsize + int(record["n"]) * self.atom.itemsize
+                if end > size:
+                    break
+                self.records.append((tag, offset))
+                self.times.append(float(record["time"]))
+                offset = end
+            elif tag == b"D":
+                if offset + delta_dtype.itemsize > size:
+                    break
+                record = np.frombuffer(self.data, dtype=delta_dtype, count=1, offset=offset)[0]
+                end = offset + (delta_dtype.itemsize + int(record["removed"]) * 4 + int(record["added"]) * self.atom.itemsize
+                                + int(record["moved"]) * self.move.itemsize)
+                if end > size:
+                    break
+                self.records.append((tag, offset))
+                self.times.append(float(record["time"]))
+                offset = end
+            else:
+                raise ValueError(f"Unknown record {tag} at byte {offset - 1}")
+            self.end = offset
+        self.lookup = np.array([self.symbols.get(code, "X") for code in range(256)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.data.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        # walks forward applying deltas rather than rebuilding every frame from its keyframe
+        state = None
+        for i in range(len(self)):
+            state = self.apply(state, i)
+            yield self.unpack(i, state)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        start = i
+        while self.records[start][0] != b"K":
+            start -= 1
+        state = None
+        for j in range(start, i + 1):
+            state = self.apply(state, j)
+        return self.unpack(i, state)
+
+    def apply(self, state, i):
+        """Takes the (ids, codes, pos) of frame i-1 (sorted by id) and returns frame i"""
+        tag, offset = self.records[i]
+        if tag == b"K":
+            n = int(np.frombuffer(self.data, dtype=key_dtype, count=1, offset=offset)[0]["n"])
+            rows = np.frombuffer(self.data, dtype=self.atom, count=n, offset=offset + key_dtype.itemsize)
+            return rows["id"].copy(), rows["code"].copy(), rows["pos"].astype(np.int32)
+
+        record = np.frombuffer(self.data, dtype=delta_dtype, count=1, offset=offset)[0]
+        offset += delta_dtype.itemsize
+        removed = np.frombuffer(self.data, dtype="<u4", count=int(record["removed"]), offset=offset)
+        offset += removed.nbytes
+        added = np.frombuffer(self.data, dtype=self.atom, count=int(record["added"]), offset=offset)
+        offset += added.nbytes
+        moved = np.frombuffer(self.data, dtype=self.move, count=int(record["moved"]), offset=offset)
+
+        ids, codes, pos = state
+        keep = ~np.isin(ids, removed)
+        ids, codes, pos = ids[keep], codes[keep], pos[keep]
+        ids = np.concatenate([ids, added["id"]])
+        codes = np.concatenate([codes, added["code"]])
+        pos = np.concatenate([pos, added["pos"].astype(np.int32)])
+        order = np.argsort(ids)
+        ids, codes, pos = ids[order], codes[order], pos[order]
+        pos[np.searchsorted(ids, moved["id"])] = moved["pos"]
+        return ids, codes, pos
+
+    def unpack(self, i, state):
+        ids, codes, pos = state
+        return self.times[i], self.lookup[codes], pos
+
+    def to_extxyz(self, path, frames=None):
+        """Writes the given frame numbers (all of them by default) out as an extxyz file"""
+        with ExtxyzWriter(path) as writer:
+            if frames is None:
+                for time, species, pos in self:
+                    writer.file.write(writer.format(self.box, species, pos))
+            else:
+                for i in frames:
+                    time, species, pos = self[i]
+                    writer.file.write(writer.format(self.box, species, pos))